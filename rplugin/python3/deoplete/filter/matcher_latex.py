@@ -0,0 +1,41 @@
+# =============================================================================
+# ------------------------ Matcher for the LaTeX source -----------------------
+# =============================================================================
+
+import re
+
+from .base import Base
+
+
+class Filter(Base):
+    """Fuzzy matching, except for symbol lookups and doc searches, whose
+    candidates look nothing like what was typed. The LaTeX source has
+    already matched those itself.
+    """
+
+    def __init__(self, vim):
+        super().__init__(vim)
+        self.name = 'matcher_latex'
+        self.description = 'fuzzy matcher passing LaTeX symbol lookups'
+
+    def filter(self, context):
+        complete_str = context['complete_str']
+        trigger, doc_trigger = (
+            context['vars'].get('deoplete#sources#latex#' + name) for
+            name in ('symbol_trigger', 'doc_trigger'))
+        if any(t and complete_str.startswith(t) for t in (trigger,
+                                                          doc_trigger)):
+            return context['candidates']
+        # Glyph lookups show the glyph first in ``abbr``.
+        if trigger and len(complete_str) == 1 and complete_str > '\x7f':
+            return [x for x in context['candidates'] if
+                    x.get('abbr', '').startswith(complete_str)]
+        if context['ignorecase']:
+            complete_str = complete_str.lower()
+        # Same as deoplete's ``fuzzy_escape``, sans camel case.
+        pattern = re.compile(re.sub(r'([a-zA-Z0-9_])', r'\1.*',
+                                    re.escape(complete_str)))
+        if context['ignorecase']:
+            return [x for x in context['candidates'] if
+                    pattern.match(x['word'].lower())]
+        return [x for x in context['candidates'] if pattern.match(x['word'])]
@@ -0,0 +1,3017 @@
+# =============================================================================
+# ------------------------ Completion engine for LaTeX ------------------------
+# =============================================================================
+#
+# Everything the deoplete source does, minus the editor. The source in
+# ``sources/deoplete_latex.py`` adapts it to Neovim; ``Headless`` stands in
+# for an editor in scripts and benchmarks:
+#
+# >>> engine = Engine(Headless({1: ['\\usepackage{amsmath}']}))
+# >>> engine.load({})
+# >>> engine.set_packages(1)
+# >>> engine.complete('$\\fr', 4, 'math', 1).candidates
+#
+# Run as a script, it's a daemon serving ``RemoteEngine`` clients, so that
+# editors share one copy of the package data. See ``serve``.
+
+import bisect
+import heapq
+import itertools
+import json
+import lzma
+import mmap
+import os
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict, deque, namedtuple
+from collections.abc import MutableMapping, Sequence
+from concurrent import futures
+
+# Immutable candidates contributed by a single package. Built once, then
+# shared by every universe that includes the package. ``source`` is the
+# package data the block was made from, for detecting reloads. ``envcmds``
+# maps environments to commands only valid inside them, ``env_aliases``
+# maps environments to those they behave like, e.g., longtable -> tabular.
+Block = namedtuple('Block', 'source math text envs options '
+                            'envcmds env_aliases')
+
+# Everything ``gather_candidates`` offers for one set of packages.
+# ``shared`` maps option pools unlocked by package args, e.g., colors, to
+# items, merged from those of each arg given. See ``_get_arg_pools``.
+# ``memo`` holds command lists derived on demand, e.g., those reranked for
+# an environment. Universes are snapshots: candidate collections are tuples,
+# memo entries are only ever added, and changes mean building a new
+# universe and swapping it in. Readers, including a worker thread, need no
+# locks. Items themselves are shared, so treat them as read-only, too.
+Universe = namedtuple('Universe', 'math text envs packs clss options shared '
+                                  'envcmds env_aliases memo')
+
+# Key=value pairs accepted by an argument. ``keys`` holds ready-made items.
+# ``values`` maps keys to value items or, for values drawn from a shared
+# pool, e.g., ``linkcolor=#%color``, to the pool's name.
+Keyvals = namedtuple('Keyvals', 'keys values')
+
+# What ``Engine.complete`` returns. ``start`` is the column completion
+# begins at, -1 for none. ``pending`` means candidates are stand-ins while
+# a universe is still assembled; ask again.
+Completion = namedtuple('Completion', 'start candidates pending')
+
+
+class Editor:
+    """What the engine needs from an editor. Buffer ids are whatever the
+    adapter uses, e.g., Vim buffer numbers.
+    """
+
+    def lines(self, buffer_id):
+        """Return a buffer's lines, as a sequence. Only slices of it are
+        read when possible.
+        """
+        raise NotImplementedError
+
+    def path(self, buffer_id):
+        """Return the file name of a buffer, '' if it has none."""
+        raise NotImplementedError
+
+    def delegate(self, cinput, complete_str):
+        """Return candidates from the editor's own completion for input it
+        knows better, e.g., citations, else None.
+        """
+        return None
+
+
+class Headless(Editor):
+    """An editor without one, for driving the engine from scripts and
+    benchmarks. ``buffers`` maps ids to lists of lines, ``paths`` maps ids
+    to file names, and both may be changed at will.
+    """
+
+    def __init__(self, buffers=None, paths=None):
+        self.buffers = dict(buffers or {})
+        self.paths = dict(paths or {})
+
+    def lines(self, buffer_id):
+        return self.buffers.get(buffer_id, [])
+
+    def path(self, buffer_id):
+        return self.paths.get(buffer_id, '')
+
+
+class PackageStore(MutableMapping):
+    """Package data read on demand from the database exported by
+    ``resources/make_sqlite.py``, in place of the ``latest.json`` dict.
+    Packages are assembled on first access and kept. Assignments, e.g.,
+    user cwl files, only live in memory.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._infos = dict(conn.execute('SELECT name, info FROM packages'))
+        self._data = {}
+
+    def __getitem__(self, name):
+        data = self._data.get(name)
+        if data is None:
+            if name not in self._infos:
+                raise KeyError(name)
+            data = self._data[name] = self._read(name)
+        return data
+
+    def __setitem__(self, name, data):
+        self._data[name] = data
+        self._infos[name] = data.get('info')
+
+    def __delitem__(self, name):
+        del self._infos[name]
+        self._data.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self._infos
+
+    def __iter__(self):
+        return iter(self._infos)
+
+    def __len__(self):
+        return len(self._infos)
+
+    def info(self, name):
+        """Same as ``self[name].get('info')``, minus the loading."""
+        data = self._data.get(name)
+        return self._infos[name] if data is None else data.get('info')
+
+    def iter_commands(self):
+        """Yield ``(package, cmd, entry)`` for all commands. Entries of
+        packages not loaded only hold ``symbol`` and ``info``.
+        """
+        for packname, cmd, symbol, info in self.conn.execute(
+                'SELECT package, name, symbol, info FROM commands'):
+            if packname not in self._data:
+                yield packname, cmd, {'symbol': symbol, 'info': info}
+        for packname, data in list(self._data.items()):
+            for cmd, cdata in (data.get('commands') or {}).items():
+                yield packname, cmd, cdata
+
+    def _read(self, name):
+        query = self.conn.execute
+        info, includes = query('SELECT info, includes FROM packages '
+                               'WHERE name = ?', (name,)).fetchone()
+        data = dict(info=info, includes=includes and json.loads(includes))
+        for catname in ('commands', 'environments'):
+            data[catname] = {entname: json.loads(entdata) for
+                             entname, entdata in query(
+                                 'SELECT name, data FROM %s WHERE package = ? '
+                                 'ORDER BY rowid' % catname, (name,))}
+        # Option names come as a list or as keys with per-option data.
+        options = data['options'] = {}
+        for optcmd, opt, optdata in query(
+                'SELECT command, name, data FROM options WHERE package = ? '
+                'ORDER BY rowid', (name,)):
+            if optdata is None:
+                options.setdefault(optcmd, []).append(opt)
+            else:
+                options.setdefault(optcmd, {})[opt] = json.loads(optdata)
+        return data
+
+
+class StrRef:
+    """A string in a pack's string table, decoded by ``str()`` whenever
+    it's needed. Until then, only the mapped pages hold it, shared with
+    other processes using the same pack. See ``PackedStore``.
+    """
+
+    __slots__ = ('table', 'start', 'stop')
+
+    def __init__(self, table, start, stop):
+        self.table = table
+        self.start = start
+        self.stop = stop
+
+    def __str__(self):
+        return self.table[self.start:self.stop].decode()
+
+    def __bool__(self):
+        return self.stop > self.start
+
+    def __repr__(self):
+        return 'StrRef(%r)' % str(self)
+
+
+def _text(value):
+    """Return a ``sig`` or ``info`` value as a string, None if empty."""
+    if not value:
+        return None
+    if isinstance(value, StrRef):
+        return str(value)
+    return value if isinstance(value, str) else '\n'.join(map(str, value))
+
+
+class PackedStore(PackageStore):
+    """Package data decompressed on demand from the pack exported by
+    ``resources/compact_json.py``, which is mapped into memory. Only the
+    index, holding offsets and ``info`` strings, is read up front. Entries'
+    ``sig`` and ``info`` strings are left in the pack as ``StrRef``s.
+    ``bytes_read`` tallies package data read through the map.
+    """
+
+    conn = None
+
+    def __init__(self, fpath):
+        with open(fpath, 'rb') as f:
+            magic, method = f.readline().decode().split()
+            if magic != 'DLPK2' or method not in ('zlib', 'lzma'):
+                raise ValueError('Not a pack: %s' % fpath)
+            index = json.loads(f.readline().decode())
+            start = f.tell()
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._decompress = (zlib.decompress if method == 'zlib' else
+                            lzma.decompress)
+        self._start = start
+        self._strings = start + index['strings'][0]
+        self._index = index['packages']
+        self._infos = {name: entry[2] for name, entry in
+                       self._index.items()}
+        self._data = {}
+        self.bytes_read = 0
+
+    def iter_commands(self):
+        """Same as ``PackageStore.iter_commands``, except packages not
+        loaded are decompressed, but not kept.
+        """
+        for packname in self._index:
+            if packname not in self._data:
+                for cmd, cdata in (self._read(packname).get('commands') or
+                                   {}).items():
+                    yield packname, cmd, cdata
+        for packname, data in list(self._data.items()):
+            for cmd, cdata in (data.get('commands') or {}).items():
+                yield packname, cmd, cdata
+
+    def _read(self, name):
+        offset, length, _ = self._index[name]
+        blob = self._map[self._start + offset:self._start + offset + length]
+        self.bytes_read += len(blob)
+        return json.loads(self._decompress(blob).decode(),
+                          object_hook=self._make_ref)
+
+    def _make_ref(self, obj):
+        ref = obj.get('@str')
+        if ref is None or len(obj) != 1:
+            return obj
+        start = self._strings + ref[0]
+        return StrRef(self._map, start, start + ref[1])
+
+
+def _read_json(fpath, default=None):
+    try:
+        with open(fpath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _write_json(fpath, data):
+    """Replace ``fpath`` atomically. Raises ``OSError``. Each write gets
+    its own temp file, since other editors may be saving the same file.
+    """
+    dirpath = os.path.dirname(fpath)
+    os.makedirs(dirpath, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            'w', dir=dirpath, prefix=os.path.basename(fpath) + '.',
+            suffix='.tmp', delete=False) as f:
+        try:
+            json.dump(data, f, separators=(',', ':'), sort_keys=True)
+        except Exception:
+            f.close()
+            os.remove(f.name)
+            raise
+    try:
+        os.replace(f.name, fpath)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+
+def _import_resource(resources_dir, modname):
+    """Import a script from the resources pipeline."""
+    from importlib import util
+    spec = util.spec_from_file_location(
+        'deoplete_latex_' + modname,
+        os.path.join(resources_dir, modname + '.py'))
+    module = util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Indexer:
+    """Finds and parses local style files and user cwl files, all the disk
+    reading the engine does per buffer besides listing directories. Runs in
+    a worker process fed by ``Engine._index``, see ``run_indexer``, or
+    in-process if that's off or fails. Results are deltas: only what
+    changed since the indexer last reported it.
+    """
+
+    def __init__(self, known, class_names, user_cwls, cache_dir,
+                 resources_dir):
+        # Names of packages local files mustn't shadow.
+        self.known = set(known)
+        self.class_names = class_names
+        self.user_cwls = user_cwls
+        self.cache_dir = cache_dir
+        self.resources_dir = resources_dir
+        #
+        # Local house styles: ``{fpath: (mtime, parsed)}`` and
+        # ``{name: (fpath, mtime)}``, respectively...
+        self._local_cache = {}
+        self._local_names = {}
+        self._cwl_loaded = {}
+        self._cwl_index = None
+        self._cwl_parser = None
+        #
+        # Patterns for scanning local ``.sty`` and ``.cls`` files...
+        self._local_req_RE = re.compile(r'\\(RequirePackage|usepackage|'
+                                        r'LoadClass(?:WithOptions)?)\s*'
+                                        r'(?:\[([^]]*)\])?\s*{([^}]+)}')
+        self._local_cmd_RE = re.compile(r'\\(?:(?:re)?new|provide)command'
+                                        r'\*?\s*{?\s*(\\[a-zA-Z@]+)\s*}?'
+                                        r'(?:\s*\[(\d)\])?(?:\s*\[([^]]*)\])?')
+        self._local_def_RE = re.compile(r'\\[egx]?def\s*(\\[a-zA-Z@]+)'
+                                        r'((?:#\d)*)')
+        self._local_mop_RE = re.compile(r'\\DeclareMathOperator\*?\s*'
+                                        r'{?\s*(\\[a-zA-Z@]+)')
+        self._local_env_RE = re.compile(r'\\(?:re)?newenvironment\*?\s*'
+                                        r'{([^}]+)}(?:\s*\[(\d)\])?'
+                                        r'(?:\s*\[([^]]*)\])?')
+        self._local_opt_RE = re.compile(r'\\DeclareOptionX?\s*{([^}*]+)}')
+
+    def handle(self, request):
+        """Resolve the local styles and user cwl files reachable from
+        ``names``, a preamble's packages, looking beside ``bufdir``. Return
+        a delta holding the ``(name, args)`` pairs ``found``, the
+        ``styles`` and ``cwls`` whose data changed, the styles ``gone``
+        and anything worth a ``log`` entry.
+        """
+        delta = dict(id=request.get('id'), styles={}, gone=[], cwls={},
+                     log=[])
+        delta['found'] = list(self._find_local_styles(
+            request['names'], request['bufdir'], delta))
+        for name in set(request['names']).union(n for n, _ in
+                                                 delta['found']):
+            if name in self.user_cwls:
+                self.load_user_cwl(name, delta)
+        return delta
+
+    def _find_local_styles(self, names, bufdir, delta):
+        """Resolve ``.sty`` and ``.cls`` files living beside the buffer
+        (or beside the style requiring them). Yield ``(name, args)`` pairs
+        like ``Engine._find_packages`` does, for each local style and
+        everything it loads, recursively. Local files never shadow known
+        packages.
+        """
+        pending = [(name, bufdir) for name in names]
+        seen = set()
+        while pending:
+            name, where = pending.pop()
+            if name in seen or (name in self.known and
+                                name not in self._local_names):
+                continue
+            seen.add(name)
+            fpath = next((os.path.join(where, name + ext) for ext in
+                          ('.sty', '.cls') if
+                          os.path.isfile(os.path.join(where, name + ext))),
+                         None)
+            if fpath is None:
+                # Previously resolved but since deleted or moved.
+                if self._local_names.pop(name, None):
+                    delta['gone'].append(name)
+                continue
+            mtime, parsed = self._scan_local_style(fpath)
+            if self._local_names.get(name) != (fpath, mtime):
+                delta['styles'][name] = (fpath, mtime, parsed['data'])
+                self._local_names[name] = (fpath, mtime)
+            yield name, None
+            for req, args, is_class in parsed['requires']:
+                if is_class:
+                    req = self.class_names.get(req, req)
+                yield req, args
+                pending.append((req, os.path.dirname(fpath)))
+
+    def _scan_local_style(self, fpath):
+        """Harvest loaded packages and user-facing definitions from a
+        local style file. Results are cached until its mtime changes.
+        """
+        mtime = os.path.getmtime(fpath)
+        cached = self._local_cache.get(fpath)
+        if cached and cached[0] == mtime:
+            return cached
+        with open(fpath, encoding='UTF-8', errors='replace') as f:
+            text = re.sub(r'(?<!\\)%.*', '', f.read())
+        fname = os.path.basename(fpath)
+        info = 'Defined in %s' % fname
+        requires = []
+        for m in self._local_req_RE.finditer(text):
+            for req in m.group(3).split(','):
+                if req.strip():
+                    requires.append((req.strip(), m.group(2),
+                                     m.group(1).startswith('Load')))
+        commands = {}
+        for m in self._local_cmd_RE.finditer(text):
+            cmd, nargs, default = m.groups()
+            if '@' in cmd:
+                continue
+            args = ['{arg%d}' % n for n in range(1, int(nargs or 0) + 1)]
+            if args and default is not None:
+                args[0] = '[%s]' % (default or 'opt')
+            commands[cmd] = dict(sig=(cmd + ''.join(args) if args else None),
+                                 mode=['math', 'text'], meta={},
+                                 symbol=None, info=info)
+        for m in self._local_def_RE.finditer(text):
+            cmd, params = m.groups()
+            if '@' in cmd or cmd in commands:
+                continue
+            args = ''.join('{arg%s}' % p for p in params.split('#') if p)
+            commands[cmd] = dict(sig=(cmd + args if args else None),
+                                 mode=['math', 'text'], meta={},
+                                 symbol=None, info=info)
+        for m in self._local_mop_RE.finditer(text):
+            if '@' not in m.group(1):
+                commands[m.group(1)] = dict(sig=None, mode=['math'], meta={},
+                                            symbol=None, info=info)
+        environments = {}
+        for m in self._local_env_RE.finditer(text):
+            env, nargs, default = m.groups()
+            args = ['{arg%d}' % n for n in range(1, int(nargs or 0) + 1)]
+            if args and default is not None:
+                args[0] = '[%s]' % (default or 'opt')
+            environments[env.strip()] = dict(
+                sig=('\\begin{%s}%s' % (env.strip(), ''.join(args)) if
+                     args else None),
+                mode=['text'], meta={}, info=info)
+        opts = sorted(set(m.group(1).strip() for m in
+                          self._local_opt_RE.finditer(text)))
+        optcmd = ('\\documentclass' if fpath.endswith('.cls') else
+                  '\\usepackage')
+        data = dict(commands=commands, environments=environments,
+                    options=({optcmd: opts} if opts else {}), info=info)
+        self._local_cache[fpath] = (mtime, dict(requires=requires, data=data))
+        return self._local_cache[fpath]
+
+    def load_user_cwl(self, name, delta):
+        """Add a user cwl file to ``delta``, along with any user files it
+        includes, unless they're unchanged since last added. Parse results
+        are kept in an index keyed by file mtime that persists across
+        sessions.
+        """
+        fpath = self.user_cwls[name]
+        try:
+            mtime = os.path.getmtime(fpath)
+        except OSError:
+            return
+        if self._cwl_loaded.get(name) == mtime:
+            return
+        index_fpath = os.path.join(self.cache_dir, 'cwl_index.json')
+        if self._cwl_index is None:
+            self._cwl_index = _read_json(index_fpath, {})
+        entry = self._cwl_index.get(fpath)
+        if not entry or entry['mtime'] != mtime:
+            data = self._parse_user_cwl(name, fpath, delta)
+            if data is None:
+                return
+            entry = self._cwl_index[fpath] = dict(mtime=mtime, data=data)
+            try:
+                _write_json(index_fpath, self._cwl_index)
+            except OSError as err:
+                delta['log'].append('Could not write %s: %r' %
+                                    (index_fpath, err))
+        self._cwl_loaded[name] = mtime
+        delta['cwls'][name] = entry['data']
+        for pack in entry['data'].get('includes') or ():
+            if pack in self.user_cwls:
+                self.load_user_cwl(pack, delta)
+
+    def _parse_user_cwl(self, name, fpath, delta):
+        """Run a cwl file through the same harvesting logic as the
+        resources pipeline (see ``get_cwl`` and ``meld_mj_refman``).
+        """
+        if self._cwl_parser is None:
+            self._cwl_parser = _import_resource(self.resources_dir, 'get_cwl')
+        parser = self._cwl_parser
+        try:
+            pkgname, data = parser.read_cwl(fpath)
+            data = parser.fill_packages({pkgname: data})[pkgname]
+        except Exception as err:
+            # Crowd-sourced files trip the pipeline's assertions now and then.
+            delta['log'].append('Failed parsing %s: %r' % (fpath, err))
+            return None
+        for catname in ('commands', 'environments'):
+            for entdata in (data.get(catname) or {}).values():
+                parser.finalize_entry(name, catname, entdata)
+                # Same defaults as ``meld_mj_refman.fix_modes``...
+                if not entdata['mode']:
+                    entdata['mode'] = (['math', 'text'] if 'math' in name and
+                                       catname == 'commands' else ['text'])
+        data.update(info='User cwl: %s' % fpath)
+        return data
+
+
+# Environments typeset in math mode, for guessing the mode without the
+# editor's syntax highlighting. ``$$`` stands for Markdown math blocks. See
+# ``Engine._guess_mode``.
+MATH_ENVS = frozenset('math displaymath equation equation* eqnarray '
+                      'eqnarray* align align* alignat alignat* flalign '
+                      'flalign* gather gather* multline multline* dmath '
+                      'dmath* $$'.split())
+
+# Packages assumed in buffers of other filetypes holding LaTeX math, e.g.,
+# Markdown, besides any their header includes. Renderers like MathJax and
+# KaTeX support these.
+MATH_ONLY_PACKAGES = ('amsmath', 'amssymb')
+
+# Commands worth pushing up inside an environment, beyond those tagged as
+# environment-specific in the cwl data.
+ENV_COMMANDS = {'tabular': ('\\hline', '\\multicolumn', '\\cline'),
+                'array': ('\\hline', '\\multicolumn', '\\cline'),
+                'tabularx': ('\\hline', '\\multicolumn', '\\cline'),
+                'tabulary': ('\\hline', '\\multicolumn', '\\cline'),
+                'tabular*': ('\\hline', '\\multicolumn', '\\cline'),
+                'longtable': ('\\hline', '\\multicolumn', '\\cline'),
+                'itemize': ('\\item',),
+                'enumerate': ('\\item',),
+                'description': ('\\item',),
+                'tabbing': ('\\=', '\\>', '\\<', '\\+', '\\-',
+                            "\\'", '\\`')}
+
+
+class Engine:
+    """Completion for LaTeX buffers. Call ``load`` once, ``set_packages``
+    whenever a buffer's preamble may have changed, then ``complete`` and
+    ``document`` as needed. ``debug``, if given, is called with log
+    messages.
+    """
+
+    def __init__(self, editor, debug=None):
+        self.editor = editor
+        self.debug = debug
+        self.debug_enabled = debug is not None
+
+    def load(self, vars, fpath=None, vimtex_maps=None):
+        """Read package data and settings. ``vars`` holds the source's
+        global variables, e.g., ``deoplete#sources#latex#cache_dir``.
+        ``fpath`` is the first file edited, for finding its project's
+        package history. ``vimtex_maps`` maps commands to vimtex imaps.
+        """
+        self._vimtex_maps = vimtex_maps
+        #
+        # Local house styles loaded, ``{name: (fpath, mtime)}``. Scanning
+        # them is the indexer's job. See ``Indexer``.
+        self._local_names = {}
+        #
+        # Per-user cache files (cwl index, etc.) live here...
+        self._cache_dir = os.path.expanduser(
+            vars.get('deoplete#sources#latex#cache_dir') or
+            os.path.join(os.environ.get('XDG_CACHE_HOME') or '~/.cache',
+                         'deoplete-latex'))
+        #
+        # User-supplied cwl files, ``{name: fpath}``. These are only parsed
+        # once referenced. See ``Indexer.load_user_cwl``.
+        self._user_cwls = self._find_user_cwls(
+            vars.get('deoplete#sources#latex#cwl_path'))
+        #
+        # Local styles and user cwl files are found and parsed by the
+        # indexer, in a worker process unless ``_index_worker`` is off.
+        # Buffers' own packages, ``{buffer_id: {name: args}}``, and those
+        # the indexer found they load, ``{buffer_id: [(name, args), ...]}``.
+        self._index_worker = vars.get('deoplete#sources#latex#index_worker',
+                                      1)
+        self._buffer_wits = {}
+        self._buffer_found = {}
+        #
+        # File-name args: ``{dirpath: (mtime_ns, [(name, is_dir), ...])}``
+        self._dir_cache = {}
+        #
+        # Per-buffer state. Buffers map to a frozen set of ``(package, args)``
+        # pairs, which in turn key an LRU of assembled universes.
+        self._buffer_keys = {}
+        self._graphicspaths = {}
+        self._blocks = {}
+        # Option pools unlocked by one package arg, ``{(package, arg):
+        # (source, {pool: items})}``, like blocks, e.g., xcolor's svgnames.
+        self._arg_pools = {}
+        self._universes = OrderedDict()
+        self._universes_max = 8
+        #
+        # Items for words offered by several packages, merged into one, by
+        # the ids of the items merged. Shared by universes, like the rest.
+        # See ``_dedupe``.
+        self._merged = {}
+        # Items with pack strings decoded, by id. See ``_resolve``.
+        self._resolved = {}
+        #
+        # Blocks, arg pools, merged items and prefetched universes are also
+        # added by the prewarm thread and the budget's executor. Additions
+        # and the flush in ``_assign`` hold this lock. Each flush bumps the
+        # generation, so universes assembled meanwhile can be told apart.
+        self._cache_lock = threading.Lock()
+        self._generation = 0
+        #
+        # Per-keystroke latency budget, in seconds. With one, universes are
+        # assembled in a worker thread, and slow keystrokes get the last
+        # good candidates for the same kind of context in the same buffer,
+        # by ``(buffer_id, kind)``. See ``complete``.
+        self._budget = vars.get('deoplete#sources#latex#latency_budget',
+                                0) / 1000
+        self._executor = None
+        self._building = {}
+        self._last_good = {}
+        self._overruns = Counter()
+        #
+        # Package blocks built ahead of time, for packages named in the
+        # config or found in the package history, which records preambles
+        # per project and globally across sessions. See ``_prewarm``.
+        self._prewarm_names = list(
+            vars.get('deoplete#sources#latex#prewarm') or ())
+        self._history_max = vars.get(
+            'deoplete#sources#latex#prewarm_history', 20)
+        self._history = self._load_cache('history.json', {})
+        self._history.setdefault('global', {})
+        self._history.setdefault('projects', {})
+        self._history_seen = set()
+        self._prewarm_cap = vars.get('deoplete#sources#latex#prewarm_max_mb',
+                                     32) * 2**20
+        self._prewarm_secs = vars.get(
+            'deoplete#sources#latex#prewarm_max_secs', 5)
+        self._prewarm_stop = threading.Event()
+        self._prefetched = {}
+        self._last_activity = 0
+        self._idle_delay = 1
+        #
+        # Environments open at the end of each line, per buffer. See
+        # ``_env_stack`` for how these are kept current.
+        self._env_stacks = {}
+        #
+        # Buffers with at least ``_large_lines`` lines, as of their last
+        # event, get cheaper strategies: only ``_scan_window`` lines are
+        # read for the preamble or above the cursor, usage isn't counted
+        # from the text, and the mode is guessed locally. See
+        # ``_check_large``.
+        self._large_lines = vars.get(
+            'deoplete#sources#latex#large_buffer_lines', 10000)
+        self._scan_window = 1000
+        self._large_buffers = set()
+        #
+        # Buffers of other filetypes, e.g., Markdown, only offered math.
+        # See ``set_packages``.
+        self._math_buffers = set()
+        self._env_commands = dict(ENV_COMMANDS)
+        self._env_commands.update(
+            vars.get('deoplete#sources#latex#env_commands') or {})
+        #
+        # Optional packages offered in every buffer...
+        self._extras = tuple(name for name, var in (
+            ('misc-web', 'deoplete#sources#latex#include_web_math'),
+            ('misc-other', 'deoplete#sources#latex#include_misc')) if
+            vars.get(var, self.debug_enabled))
+        #
+        # Usage counts of commands and environments, persisted per user.
+        # Accepted completions are batched in ``_usage_pending`` until the
+        # next save. See ``_update_usage``.
+        self._usage = (Counter(self._load_cache('usage.json', {})) if
+                       vars.get('deoplete#sources#latex#usage_ranking', 1)
+                       else None)
+        self._usage_pending = Counter()
+        self._usage_saved = time.time()
+        self._buffer_usage = {}
+        self._usage_RE = re.compile(r'\\[a-zA-Z@]+\*?|(?<=\\begin{)[^}]+')
+        #
+        # Commands from packages not loaded in the buffer, offered last.
+        # The reverse index, ``{cmd: [mode_bits, package, ...]}``, is only
+        # read, or built in the cache dir, once needed. See
+        # ``resources/make_cmd_index.py``.
+        self._suggest_unloaded = vars.get(
+            'deoplete#sources#latex#suggest_unloaded', 0)
+        self._cmd_index = None
+        #
+        # Reverse lookup from unicode glyphs and names to commands, e.g., a
+        # typed ``≤`` or ``<trigger>less-than`` -> ``\\leq``. Off unless a
+        # trigger is set. See ``_make_symbol_index``.
+        self._symbol_trigger = vars.get(
+            'deoplete#sources#latex#symbol_trigger')
+        #
+        # Package data comes from ``latest.json`` or, with "sqlite", from a
+        # database read as needed. The latter adds full-text search of the
+        # docs in ``info``, behind ``_doc_trigger``.
+        self._storage = vars.get('deoplete#sources#latex#storage', 'json')
+        self._doc_trigger = vars.get('deoplete#sources#latex#doc_trigger')
+        # Populate completion lists...
+        self._make_lists()
+        #
+        # Lookups trigger on input the editor wouldn't otherwise complete.
+        # Their candidates don't match what's typed, so the editor needs to
+        # let them through unfiltered.
+        self.input_patterns = []
+        if self._symbol_trigger:
+            self._make_symbol_index()
+            # The trigger starts a token and a word follows right away, so
+            # prose like "foo; and" is left alone.
+            self._symbol_RE = re.compile(
+                r'(?:[^\x00-\x7f]|(?:^|(?<=\s))%s(?:\w[\w -]*)?)$' %
+                re.escape(self._symbol_trigger))
+            self.input_patterns.append(self._symbol_RE.pattern)
+        if getattr(self._packages, 'conn', None) is None:
+            self._doc_trigger = None
+        if self._doc_trigger:
+            self._doc_RE = re.compile(r'%s[\w -]*$' %
+                                      re.escape(self._doc_trigger))
+            self.input_patterns.append(self._doc_RE.pattern)
+        #
+        # Patterns for "math" and "text" modes, respectively...
+        self._mRE = re.compile(r"\\?\w*$|"
+                               r"(?<=end\{)[^}]*$", re.IGNORECASE)
+        #
+        self._tRE = re.compile(r"\\?\w*$|"
+                               r"(?<=\w\[)[^],]*$|"
+                               r"(?<=\w,)[^],]*$|"
+                               r"(?<=\S\{)[^}]*$", re.IGNORECASE)
+        #
+        # Pattern for `\documentclass` and `\usepackage` options.
+        self._dcup_opt_RE = re.compile(r'^(?:.*)(\\\w+)'
+                                       r'(?:.*)\[(?:[^]]*)?(?:]?{(.*)})')
+        #
+        # Environment delimiters, for ``_scan_envs``, and an environment
+        # name being typed.
+        self._env_RE = re.compile(r'\\(begin|end)\s*{([^}]+)}')
+        self._env_arg_RE = re.compile(r'\\(begin|end)\s*{[^}]*$')
+        #
+        # Markdown code spans, closed inline math and an open ``$``. See
+        # ``_guess_mode``.
+        self._md_code_RE = re.compile(r'(`+).*?\1')
+        self._md_math_RE = re.compile(r'\$[^$\s](?:[^$]*[^$\s])?\$(?!\d)')
+        self._md_open_RE = re.compile(r'\$(?=[^$\s\d])[^$]*$')
+        #
+        # Cwl keyvals, e.g., ``width=##L``, ``clip#true,false``, and the
+        # argument the cursor was last found in. See ``_find_slot``.
+        self._keyval_RE = re.compile(r'([^=#]+)(=?)(#?)(.*)$')
+        self._slot_memo = (None, None, None)
+        #
+        # Commands taking file names: ``{cmd: (extensions, implicit_ext)}``.
+        # An extension LaTeX appends by itself is dropped from candidates.
+        graphics_exts = ('.pdf', '.png', '.jpg', '.jpeg', '.eps', '.ps',
+                         '.mps', '.jbig2', '.jb2')
+        self._path_cmds = {'includegraphics': (graphics_exts, None),
+                           'input': (('.tex', '.tikz', '.pgf'), '.tex'),
+                           'include': (('.tex',), '.tex'),
+                           'includeonly': (('.tex',), '.tex'),
+                           'subfile': (('.tex',), None),
+                           'includepdf': (('.pdf',), None),
+                           'bibliography': (('.bib',), '.bib'),
+                           'addbibresource': (('.bib',), None),
+                           'lstinputlisting': (None, None),
+                           'verbatiminput': (None, None)}
+        self._path_RE = re.compile(r'\\(%s)\*?(?:\[[^]]*\])*{([^}]*)$' %
+                                   '|'.join(self._path_cmds))
+        #
+        # Start prewarming last, once everything it relies on is in place.
+        names, key, local = self._prewarm_names, None, {}
+        names = [name if name in self._packages else
+                 self._class_names.get(name, name) for name in names]
+        if self._history_max:
+            project = self._history['projects'].get(
+                self._project_root(fpath), {})
+            for counts in (project.get('packages', {}),
+                           self._history['global']):
+                names += sorted(counts, key=counts.get,
+                                reverse=True)[:self._history_max]
+            key = frozenset((name, args) for name, args in
+                            project.get('key', ()))
+            local = project.get('local', {})
+        if names and self._prewarm_cap:
+            threading.Thread(target=self._prewarm, args=(names, key, local),
+                             name='deoplete-latex-prewarm',
+                             daemon=True).start()
+
+    def find_start(self, cinput, mode='text', buffer_id=None, lnum=None):
+        """Return the column at which completion of ``cinput``, the line up
+        to the cursor, starts, or -1 if there's nothing to complete. A
+        ``mode`` of None is guessed, see ``_guess_mode``.
+        """
+        # Indexer findings land between keystrokes.
+        if self._index_deltas:
+            for updated in self._apply_index():
+                self._assign(updated)
+        if buffer_id in self._math_buffers and (
+                mode or self._guess_mode(cinput, buffer_id, lnum)) != 'math':
+            return -1
+        #
+        # XXX - Simply searching for end instead is probably faster. See
+        # deoplete-jedi, which uses something like this:
+        #
+        # >>> m = re.search(r'[{([,]$', cinput)
+        # >>> if m: return m.end()
+        # >>> m = re.search(r'\\?\w+$', cinput)
+        #
+        if self._doc_trigger:
+            m = self._doc_RE.search(cinput)
+            if m:
+                return m.start()
+        if self._symbol_trigger:
+            m = self._symbol_RE.search(cinput)
+            if m and self._match_symbols(m.group()):
+                return m.start()
+        universe = self._universe(buffer_id, 0)
+        slot = universe and self._find_slot(cinput, universe)
+        if slot:
+            return slot[3]
+        if mode is None:
+            mode = self._guess_mode(cinput, buffer_id, lnum)
+        useRE = self._mRE if mode == 'math' else self._tRE
+        m = useRE.search(cinput)
+        return m.start() if m else -1
+
+    def complete(self, line, col, mode='text', buffer_id=None, lnum=None):
+        """Return a ``Completion`` for the cursor at ``col`` in ``line``.
+        ``mode`` is "math" or "text", or None to guess. Given ``lnum``, the
+        cursor's line in ``buffer_id`` counting from 1, environments opened
+        above are taken into account.
+
+        The latency budget, if any, is enforced around ``_gather``. When a
+        universe isn't ready in time, the last good candidates for the same
+        kind of context in the same buffer are offered instead, if any, as
+        ``pending``. Other buffers' are never offered, since they may have
+        other packages. Overruns are counted per kind. Either way, callers
+        get a list of their own, never a snapshot, with any pack strings
+        decoded. See ``_resolve``.
+        """
+        start, cands, pending = self._complete(line, col, mode, buffer_id,
+                                               lnum)
+        return Completion(start, self._resolve(cands), pending)
+
+    def _complete(self, line, col, mode, buffer_id, lnum):
+        """Same as ``complete``, but candidates are left as gathered, e.g.,
+        a universe's own tuple, for the daemon to tell apart.
+        """
+        self._last_activity = time.time()
+        cinput = line[:col]
+        if mode is None:
+            mode = self._guess_mode(cinput, buffer_id, lnum)
+        start = self.find_start(cinput, mode, buffer_id)
+        if start < 0:
+            return Completion(start, (), False)
+        args = (cinput, line[col:], cinput[start:], mode, buffer_id, lnum)
+        if not self._budget:
+            return Completion(start, self._gather(*args), False)
+        started = time.time()
+        self._deadline = started + self._budget
+        kind = self._context_kind(cinput)
+        cands = self._gather(*args)
+        elapsed = time.time() - started
+        if cands is None or elapsed > self._budget:
+            self._overruns[kind] += 1
+            self.debug_enabled and self._whine(
+                'Over budget: %s took %.1fms (%d times)%s' %
+                (kind, elapsed * 1000, self._overruns[kind],
+                 ', still assembling' if cands is None else ''))
+        if cands is None:
+            return Completion(start,
+                              self._last_good.get((buffer_id, kind), ()),
+                              True)
+        self._last_good[buffer_id, kind] = cands = tuple(cands)
+        return Completion(start, cands, False)
+
+    def document(self, word, buffer_id=None):
+        """Return the docs for a command or environment, e.g., ``\\frac``
+        or ``itemize``, as offered in a buffer, else as defined by the
+        first package that has it. None if there are none.
+        """
+        universe = self._universe(buffer_id)
+        items = universe.memo.get('items')
+        if items is None:
+            items = universe.memo['items'] = {
+                i['word']: i for i in universe.envs + universe.text +
+                universe.math}
+        if word in items:
+            return _text(items[word].get('info'))
+        if word.startswith('\\'):
+            entry = next((cdata for _, cmd, cdata in self._iter_commands() if
+                          cmd == word), None)
+        else:
+            entry = self._cats['environments'].get(word)
+        return entry and _text(self._make_item(word, entry,
+                                               'commands').get('info'))
+
+    def set_packages(self, buffer_id, preamble=None, math_only=False):
+        """Load the packages a buffer's preamble asks for, along with local
+        styles and user cwl files. ``preamble`` is the buffer's lines, read
+        up to ``\\begin{document}``, and is fetched from the editor if not
+        given. Other buffers keep whatever universe they were last
+        assigned.
+
+        With ``math_only``, the buffer isn't LaTeX but holds math between
+        delimiters, e.g., Markdown. Completion only happens there, and
+        ``MATH_ONLY_PACKAGES`` are loaded besides any in the preamble.
+        """
+        # Using cwl "prefixed/long" form of class names, e.g., ``class-foo``,
+        # to guard against collisions. XXX - verify reasoning because
+        # readability suffers. Some packs, like "yathesis", define a "class"
+        # as the dominant mode but the cwl filename doesn't reflect this...
+        self._last_activity = time.time()
+        large = self._check_large(buffer_id)
+        if math_only:
+            self._math_buffers.add(buffer_id)
+        else:
+            self._math_buffers.discard(buffer_id)
+        if preamble is None:
+            preamble = self.editor.lines(buffer_id)
+            # Without ``\begin{document}``, math buffers would be read whole.
+            if large or math_only:
+                preamble = preamble[:self._scan_window]
+        lines = []
+        for line in preamble:
+            if '\\begin{document}' in line:
+                break
+            lines.append(line)
+        bufdir = os.path.dirname(self.editor.path(buffer_id)) or os.curdir
+        self._env_stacks.pop(buffer_id, None)
+        self._buffer_wits[buffer_id] = dict(self._find_packages(lines))
+        if math_only:
+            for name in MATH_ONLY_PACKAGES:
+                self._buffer_wits[buffer_id].setdefault(name, None)
+        self._graphicspaths[buffer_id] = self._find_graphicspath(lines)
+        # Local styles and user cwl files are left to the indexer. Until it
+        # reports back, what it found last time stands.
+        self._index(buffer_id, list(self._buffer_wits[buffer_id]), bufdir)
+        # Rerank this buffer's universe if usage changed. Others catch up
+        # whenever they're next rebuilt.
+        rerank = self._usage is not None and self._update_usage(buffer_id,
+                                                                large)
+        updated = self._apply_index()
+        for other in updated - {buffer_id}:
+            self._assign(other)
+        self._assign(buffer_id, rerank)
+
+    def _assign(self, buffer_id, rerank=False):
+        """Key a buffer's universe by its packages, including those found
+        by the indexer, and build it if need be.
+        """
+        witgroups = dict(self._buffer_wits[buffer_id])
+        # Fold in local styles and whatever they load. Args given in the
+        # buffer itself take precedence.
+        for wit, args in self._buffer_found.get(buffer_id, ()):
+            witgroups.setdefault(wit, args)
+        loadable = (self._cats['packages'].keys() |
+                    set(self._class_names.values()) |
+                    self._local_names.keys())
+        key = frozenset((wit, args) for wit, args in witgroups.items() if
+                        wit in loadable and wit in self._packages)
+        # Blocks made from since-reloaded package data (local styles, user
+        # cwl files) are stale, as is every universe built from them.
+        with self._cache_lock:
+            stale = [name for name, block in self._blocks.items() if
+                     name is not None and
+                     block.source is not self._packages.get(name)]
+            if stale:
+                for name in stale:
+                    self._blocks.pop(name)
+                self._arg_pools = {k: v for k, v in self._arg_pools.items()
+                                   if k[0] not in stale}
+                self._merged.clear()
+                self._prefetched.clear()
+                self._generation += 1
+        if stale:
+            self.debug_enabled and self._whine(
+                '"%r" changed, dropping cached universes...' % stale)
+            self._resolved.clear()
+            self._universes.clear()
+            self._building.clear()
+        # Reranking keeps any prefetched universe. It's ranked by counts
+        # from past sessions, which is all a buffer's first save adds.
+        if rerank:
+            self._universes.pop(key, None)
+            self._building.pop(key, None)
+        if key != self._buffer_keys.get(buffer_id):
+            self.debug_enabled and self._whine(
+                'Buffer %s packages: %r' % (buffer_id, sorted(dict(key))))
+            self._buffer_keys[buffer_id] = key
+            self._update_history(key, self.editor.path(buffer_id))
+        # Build now rather than on the next keystroke.
+        self._universe(buffer_id, 0)
+
+    def record_completion(self, word):
+        """Count a completion the user accepted, for usage ranking."""
+        self._last_activity = time.time()
+        if self._usage is not None and word:
+            self._usage_pending[word] += 1
+
+    def close(self):
+        """Stop background work and save state, e.g., on exit."""
+        self._prewarm_stop.set()
+        self._usage and self._save_usage()
+        if self._index_proc is not None:
+            # The worker exits once its input ends.
+            self._index_proc.stdin.close()
+            self._index_proc = None
+
+    def drop_buffer(self, buffer_id):
+        """Forget a buffer, e.g., once it's wiped. Universes stay cached
+        for other buffers with the same packages.
+        """
+        for state in (self._buffer_keys, self._buffer_wits,
+                      self._buffer_found, self._graphicspaths,
+                      self._env_stacks, self._buffer_usage):
+            state.pop(buffer_id, None)
+        self._large_buffers.discard(buffer_id)
+        self._math_buffers.discard(buffer_id)
+        for key in [k for k in self._last_good if k[0] == buffer_id]:
+            del self._last_good[key]
+
+    def large_buffer(self, buffer_id):
+        """Whether a buffer was large as of its last event. Editors can
+        skip their own costly context queries for these, e.g., by passing
+        a ``mode`` of None.
+        """
+        return buffer_id in self._large_buffers
+
+    def _check_large(self, buffer_id):
+        """Switch a buffer's scanning strategies by its size, logging any
+        change. Return True if it's large.
+        """
+        nlines = len(self.editor.lines(buffer_id))
+        large = bool(self._large_lines) and nlines >= self._large_lines
+        if large != (buffer_id in self._large_buffers):
+            if large:
+                self._large_buffers.add(buffer_id)
+            else:
+                self._large_buffers.discard(buffer_id)
+            self.debug_enabled and self._whine(
+                'Buffer %s has %d lines, %s large-buffer strategies: '
+                'preamble and environment scans capped at %d lines, usage '
+                'counted from completions only, mode guessed locally' %
+                (buffer_id, nlines, 'using' if large else 'dropping',
+                 self._scan_window))
+        return large
+
+    def _start_indexer(self, use_worker):
+        """Set up the in-process ``Indexer`` and, if wanted, a worker
+        process running another, whose replies a thread collects.
+        """
+        args = dict(known=list(self._packages), class_names=self._class_names,
+                    user_cwls=self._user_cwls, cache_dir=self._cache_dir,
+                    resources_dir=self._resources_dir)
+        self._indexer = Indexer(**args)
+        self._index_deltas = deque()
+        self._index_pending = {}
+        self._index_ids = itertools.count()
+        self._index_proc = None
+        if not use_worker:
+            return
+        try:
+            proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                     '--index'], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+            proc.stdin.write(json.dumps(args).encode() + b'\n')
+            proc.stdin.flush()
+        except OSError as err:
+            self.debug_enabled and self._whine(
+                'Could not start indexer: %r' % err)
+            return
+        self._index_proc = proc
+        threading.Thread(target=self._read_index, args=(proc,),
+                         name='deoplete-latex-index', daemon=True).start()
+
+    def _read_index(self, proc):
+        for line in proc.stdout:
+            self._index_deltas.append(json.loads(line.decode()))
+        if self._index_proc is proc:
+            # Died. Requests in flight are lost until the next event.
+            self._index_proc = None
+
+    def _index(self, buffer_id, names, bufdir):
+        """Ask the indexer about a buffer's packages. See ``Indexer``."""
+        request = dict(id=next(self._index_ids), names=names, bufdir=bufdir)
+        self._index_pending[request['id']] = buffer_id
+        proc = self._index_proc
+        if proc is not None:
+            try:
+                proc.stdin.write(json.dumps(request).encode() + b'\n')
+                proc.stdin.flush()
+                return
+            except OSError as err:
+                self.debug_enabled and self._whine(
+                    'Indexer gone, indexing in-process: %r' % err)
+                self._index_proc = None
+        self._index_deltas.append(self._indexer.handle(request))
+
+    def _apply_index(self):
+        """Fold indexer deltas into the package data. Return the buffers
+        whose findings came in.
+        """
+        updated = set()
+        while self._index_deltas:
+            delta = self._index_deltas.popleft()
+            for msg in delta.get('log', ()):
+                self.debug_enabled and self._whine(msg)
+            for name in delta.get('gone', ()):
+                if self._local_names.pop(name, None):
+                    self._packages.pop(name, None)
+            for name, (fpath, mtime, data) in delta.get('styles',
+                                                        {}).items():
+                with self._cache_lock:
+                    # Unchanged since prewarming read it. Replacing it
+                    # would drop the universes built from it.
+                    if (self._local_names.get(name) == (fpath, mtime) and
+                            name in self._packages):
+                        continue
+                    self._packages[name] = data
+                    self._local_names[name] = (fpath, mtime)
+            self._packages.update(delta.get('cwls', {}))
+            buffer_id = self._index_pending.pop(delta.get('id'), None)
+            if 'found' in delta and buffer_id in self._buffer_wits:
+                self._buffer_found[buffer_id] = delta['found']
+                updated.add(buffer_id)
+        return updated
+
+    def _context_kind(self, cinput):
+        """Classify input cheaply, mirroring the branches of ``_gather``.
+        """
+        if self._path_RE.search(cinput):
+            return 'paths'
+        if ((self._symbol_trigger and self._symbol_RE.search(cinput)) or
+                (self._doc_trigger and self._doc_RE.search(cinput))):
+            return 'lookups'
+        if self._env_arg_RE.search(cinput):
+            return 'environments'
+        if self._locate_arg(cinput):
+            return 'arguments'
+        return 'commands'
+
+    def _gather(self, cinput, nextin, complete_str, mode, buffer_id, lnum):
+        # TODO - Devise some way to reproduce intermittent issue re truncated
+        # suggestions in PUM.
+        #
+        self.debug_enabled and self._whine(
+            "== Selected context items ==",
+            *("{:12} : {!r}".format(*x) for x in (
+                ('input', cinput), ('next_input', nextin),
+                ('complete_str', complete_str), ('mode', mode),
+                ('lnum', lnum))),
+            dequote=True)
+        #
+        # File-name args. These take precedence over the editor's own
+        # completion, e.g., vimtex, which relists directories on every
+        # keystroke.
+        path_m = self._path_RE.search(cinput)
+        if path_m:
+            return self._gather_paths(path_m.group(1), complete_str,
+                                      buffer_id)
+        delegated = self.editor.delegate(cinput, complete_str)
+        if delegated:
+            return delegated
+        #
+        # ``:help deoplete`` says:
+        # >     Note: The source must not filter the candidates by user input.
+        # >     It is |deoplete-filters| work.
+        #
+        # Does this apply to the following? Filters rank/sort candidates by
+        # priority. This is just offering them up for consideration.
+        #
+        universe = self._universe(
+            buffer_id, self._budget and max(0, self._deadline - time.time()))
+        if universe is None:
+            return None
+        #
+        # Doc searches, then glyphs and unicode names...
+        doc_m = self._doc_trigger and self._doc_RE.search(cinput)
+        if doc_m:
+            return self._gather_docs(
+                doc_m.group()[len(self._doc_trigger):], universe)
+        if self._symbol_trigger:
+            symbol_m = self._symbol_RE.search(cinput)
+            cmds = symbol_m and self._match_symbols(symbol_m.group())
+            if cmds:
+                return self._gather_symbols(cmds, universe)
+        #
+        # Key=value lists and other argument fields, e.g., colors...
+        slot = self._find_slot(cinput, universe)
+        if slot:
+            return self._gather_slot(slot, universe)
+        # Options for `\documentclass` and `\usepackage`. For now, it only
+        # populates after the main class/package argument has been provided.
+        dcup_opt_m = self._dcup_opt_RE.match(cinput + nextin)
+        if dcup_opt_m:
+            back_cmd, embraced = dcup_opt_m.groups()
+            self.debug_enabled and self._whine(
+                "Opt match found - pack: %s, embr: %s" % (back_cmd, embraced))
+            packname = (embraced if embraced in self._packages else
+                        self._class_names.get(embraced))
+            opts = packname and (self._packages[packname].get('options') or
+                                 {}).get(back_cmd)
+            if opts:
+                return sorted((self._make_item(o, {}, 'options', packname)
+                               for o in opts),
+                              key=lambda i: i['word'].lower())
+        elif 'documentclass' in cinput:
+            if re.match(r'^\s*\\documentclass(?:\[.*?\]s?)?{[^}]*$', cinput):
+                return universe.clss
+        elif 'usepackage' in cinput:
+            if re.match(r'^\s*\\usepackage(?:\[.*?\]\s?)?{[^}]*?$', cinput):
+                return universe.packs
+        else:
+            # Environment names. For ``\\end{``, the innermost open one
+            # comes first.
+            env_m = self._env_arg_RE.search(cinput)
+            if env_m and env_m.group(1) == 'end':
+                return self._gather_end(
+                    universe, self._env_stack(buffer_id, lnum, cinput))
+            elif env_m:
+                return universe.envs
+        # Return the main commands lists, reranked for the innermost
+        # environment that has something to say.
+        return self._rank_for_envs(
+            universe, self._env_stack(buffer_id, lnum, cinput), mode)
+
+    def _rank_for_envs(self, universe, stack, mode):
+        """Put commands meant for the enclosing environment first. Lists
+        are memoized per environment, so this is a dict lookup most of the
+        time. Those the package data ties to an environment also count for
+        environments behaving like it, e.g., longtable -> tabular, but the
+        pairings in ``_env_commands`` only count for the one named, lest
+        ``align``, which behaves like ``array``, get table commands.
+        """
+        cands = self._mode_list(universe, mode)
+        for env in reversed(stack):
+            chain = (env,) + universe.env_aliases.get(env, ())
+            words = set(self._env_commands.get(env, ())).union(
+                *(universe.envcmds.get(e, ()) for e in chain))
+            if words:
+                break
+        else:
+            return cands
+        ranked = universe.memo.get((env, mode))
+        if ranked is None:
+            boosted = [i for i in cands if i['word'] in words]
+            # Some belong to the other mode, e.g., ``\\hline`` in ``array``,
+            # but ``\\item`` has no place in math inside ``itemize``.
+            if env in MATH_ENVS or 'array' in chain:
+                seen = set(i['word'] for i in boosted)
+                boosted += [i for i in (universe.text if mode == 'math' else
+                                        universe.math) if
+                            i['word'] in words and i['word'] not in seen]
+            ranked = tuple(boosted + [i for i in cands if
+                                      i['word'] not in words])
+            universe.memo[(env, mode)] = ranked
+        return ranked
+
+    def _mode_list(self, universe, mode):
+        """Return the main commands list for a mode, followed by those from
+        packages not yet loaded, if wanted.
+        """
+        if not self._suggest_unloaded:
+            return getattr(universe, mode)
+        cands = universe.memo.get((None, mode))
+        if cands is None:
+            cands = universe.memo[(None, mode)] = (
+                getattr(universe, mode) +
+                tuple(self._make_unloaded(universe, mode)))
+        return cands
+
+    def _make_unloaded(self, universe, mode):
+        """Return bare items for commands only found in packages missing
+        from a universe. These carry no sig or info; loading the packages'
+        blocks just for this would defeat the purpose.
+        """
+        if self._cmd_index is None:
+            self._cmd_index = self._open_cmd_index()
+        bit = 1 if mode == 'math' else 2
+        have = set(i['word'] for i in universe.math)
+        have.update(i['word'] for i in universe.text)
+        return [{'word': cmd, 'kind': 'cmd',
+                 'menu': 'needs ' + ' or '.join('\\usepackage{%s}' % p for
+                                                p in entry[1:])} for
+                cmd, entry in sorted(self._cmd_index.items(),
+                                     key=lambda kv: kv[0].lower()) if
+                entry[0] & bit and cmd not in have]
+
+    def _gather_end(self, universe, stack):
+        if not stack:
+            return universe.envs
+        innermost = stack[-1]
+        item = next((i for i in universe.envs if i['word'] == innermost),
+                    dict(word=innermost, kind='environment'))
+        return ([dict(item, menu='(open)')] +
+                [i for i in universe.envs if i['word'] != innermost])
+
+    def _match_symbols(self, query):
+        """Return commands for a glyph or, following the trigger, words
+        from unicode names. Each word may be abbreviated.
+        """
+        if not query.startswith(self._symbol_trigger):
+            return self._glyphs.get(query, ())
+        words, postings = self._uninames
+        found = None
+        for token in re.findall(r'\w+',
+                                query[len(self._symbol_trigger):].lower()):
+            lo = bisect.bisect_left(words, token)
+            hi = bisect.bisect_left(words, token + '\uffff', lo)
+            hits = set().union(*postings[lo:hi])
+            found = hits if found is None else found & hits
+        return found or ()
+
+    def _gather_symbols(self, cmds, universe):
+        have = self._universe_words(universe)
+        usage = self._usage or {}
+        out = []
+        for cmd in sorted(cmds, key=lambda c: (c not in have,
+                                               -usage.get(c, 0), c.lower())):
+            symbol, name, packname = self._symbols[cmd]
+            item = {'word': cmd, 'abbr': symbol + ' ' + cmd,
+                    'kind': (packname + ' cmd' if packname else 'command'),
+                    'menu': name.lower()}
+            if cmd not in have and packname:
+                item.update(menu='needs \\usepackage{%s}' % packname)
+            out.append(item)
+        return out
+
+    def _find_slot(self, cinput, universe):
+        """Return ``(opts, field, key, start)`` when the cursor is in an
+        argument with known options, else None. ``key`` is set when a value
+        is due, and ``start`` is where the word being typed begins. The
+        last result is kept, since ``get_complete_position`` and
+        ``gather_candidates`` ask about the same input.
+        """
+        memo_input, memo_universe, memo_slot = self._slot_memo
+        # Universes are snapshots. Comparing them with ``==`` would walk
+        # their candidates.
+        if memo_input == cinput and memo_universe is universe:
+            return memo_slot
+        slot = None
+        arg = self._locate_arg(cinput)
+        opts = arg and universe.options.get(arg[0])
+        field = opts and self._match_slot(opts['slots'], arg[1])
+        if field:
+            # Only the current item of a comma-separated list matters.
+            start, depth = arg[2], 0
+            for i in range(start, len(cinput)):
+                c = cinput[i]
+                if c in '{[(':
+                    depth += 1
+                elif c in '}])':
+                    depth -= 1
+                elif c == ',' and not depth:
+                    start = i + 1
+            key = None
+            eq = cinput.find('=', start)
+            if field == 'keyvals' and eq >= 0:
+                key = cinput[start:eq].strip()
+                start = eq + 1
+            while start < len(cinput) and cinput[start] in ' \t':
+                start += 1
+            slot = (opts, field, key, start)
+        self._slot_memo = (cinput, universe, slot)
+        return slot
+
+    def _locate_arg(self, cinput):
+        """Find the unclosed argument the cursor is in. Return the command
+        (or environment) owning it, the brackets of its arguments up to and
+        including this one, and where its text starts. Everything is found
+        scanning backwards once, so this is linear in the input.
+        """
+        closers = {']': '[', '}': '{', ')': '('}
+        pending = []
+        i = len(cinput)
+        while True:
+            i -= 1
+            if i < 0:
+                return None
+            c = cinput[i]
+            if c in closers:
+                pending.append(closers[c])
+            elif c in '[{(':
+                if not pending:
+                    break
+                if pending.pop() != c:
+                    return None
+        start = i + 1
+        brackets, spans = [cinput[i]], [None]
+        # Complete arguments before it, possibly spaced apart.
+        while True:
+            j = i
+            while j and cinput[j - 1] in ' \t':
+                j -= 1
+            if not j or cinput[j - 1] not in closers:
+                break
+            pending = [closers[cinput[j - 1]]]
+            k = j - 1
+            while pending:
+                k -= 1
+                if k < 0:
+                    return None
+                c = cinput[k]
+                if c in closers:
+                    pending.append(closers[c])
+                elif c in '[{(' and pending.pop() != c:
+                    return None
+            brackets.append(cinput[k])
+            spans.append((k + 1, j - 1))
+            i = k
+        while i and cinput[i - 1] in ' \t':
+            i -= 1
+        end = i
+        if i and cinput[i - 1] == '*':
+            i -= 1
+        while i and (cinput[i - 1].isalpha() or cinput[i - 1] == '@'):
+            i -= 1
+        if not i or cinput[i - 1] != '\\' or i == end:
+            return None
+        name = cinput[i - 1:end]
+        brackets.reverse()
+        spans.reverse()
+        if name == '\\begin' and len(brackets) > 1 and brackets[0] == '{':
+            name = cinput[slice(*spans[0])].strip()
+            brackets = brackets[1:]
+        return name, tuple(brackets), start
+
+    def _match_slot(self, slots, brackets):
+        """Line up typed brackets with those of each signature, skipping
+        optional args not given. Return the field of the last one.
+        """
+        for pairs in slots:
+            p = 0
+            for n, bracket in enumerate(brackets):
+                while (p < len(pairs) and pairs[p][0] != bracket and
+                       pairs[p][0] in '[('):
+                    p += 1
+                if p == len(pairs) or pairs[p][0] != bracket:
+                    break
+                if n == len(brackets) - 1 and pairs[p][1]:
+                    return pairs[p][1]
+                p += 1
+        return None
+
+    def _gather_slot(self, slot, universe):
+        opts, field, key, _ = slot
+        if field == 'keyvals':
+            if key is None:
+                return opts['keyvals'].keys
+            values = opts['keyvals'].values.get(key, ())
+        else:
+            values = opts[field]
+        if values is None or isinstance(values, str):
+            # A shared pool, e.g., colors defined by xcolor's package args.
+            return universe.shared.get(values or field, ())
+        return values
+
+    def _universe_words(self, universe):
+        """Return the names of all commands and environments offered."""
+        words = universe.memo.get('words')
+        if words is None:
+            words = universe.memo['words'] = frozenset(
+                i['word'] for i in universe.math + universe.text +
+                universe.envs)
+        return words
+
+    def _gather_docs(self, query, universe):
+        """Search the docs of all commands and environments for words
+        starting with those typed.
+        """
+        terms = ' '.join('"%s"*' % t for t in re.findall(r'\w+', query))
+        if not terms:
+            return []
+        sql = ('SELECT category, package, name, info FROM docs '
+               'WHERE info MATCH ?')
+        conn = self._packages.conn
+        try:
+            rows = conn.execute(sql + ' ORDER BY rank LIMIT 50',
+                                (terms,)).fetchall()
+        except sqlite3.OperationalError:
+            # No ``rank`` with FTS4.
+            rows = conn.execute(sql + ' LIMIT 50', (terms,)).fetchall()
+        have = self._universe_words(universe)
+        out, seen = [], set()
+        for catname, packname, entname, info in rows:
+            word = ('\\begin{%s}' % entname if catname == 'environments'
+                    else entname)
+            if word in seen:
+                continue
+            seen.add(word)
+            if entname in have or packname.startswith(('latex', 'misc')):
+                menu = None
+            elif packname.startswith('class'):
+                menu = ('needs \\documentclass{%s}' %
+                        packname[6:].split(',')[0])
+            else:
+                menu = 'needs \\usepackage{%s}' % packname
+            item = {'word': word, 'kind': self._cat2kind[catname],
+                    'info': info}
+            if menu:
+                item.update(menu=menu)
+            out.append(item)
+        return out
+
+    def _env_stack(self, buffer_id, lnum, cinput):
+        """Return the environments open at the cursor, innermost last.
+
+        Stacks are kept for each line above the cursor, computed top-down
+        as needed. Between events, edits can only have happened on lines
+        the cursor visited, so when the cursor line or line count changes,
+        only stacks from there on are dropped. Any event drops the lot.
+        Lines past the end of a buffer as last seen, e.g., the daemon's
+        copy, are taken to open nothing.
+        """
+        markdown = buffer_id in self._math_buffers
+        if lnum is None:
+            return self._scan_envs((), (cinput,), markdown)
+        buffer = self.editor.lines(buffer_id)
+        nlines = len(buffer)
+        lnum = min(lnum, nlines + 1)
+        state = self._env_stacks.get(buffer_id)
+        if state is None:
+            state = self._env_stacks[buffer_id] = dict(stacks=[], lnum=lnum,
+                                                       nlines=nlines)
+        stacks = state['stacks']
+        if state['lnum'] != lnum or state['nlines'] != nlines:
+            cut = max(min(state['lnum'], lnum) - 1, 0)
+            if cut < state.get('skipped', 0):
+                # Stand-ins for lines skipped in large buffers go, too.
+                cut = state['skipped'] = 0
+            del stacks[cut:]
+            state.update(lnum=lnum, nlines=nlines)
+        if buffer_id in self._large_buffers:
+            # Only look so far up. Lines beyond are taken to close whatever
+            # they open, which holds for all but ``document`` and the like.
+            skip = lnum - 1 - self._scan_window
+            if len(stacks) < skip:
+                stacks.extend([()] * (skip - len(stacks)))
+                state['skipped'] = skip
+        # Lines ``len(stacks)`` through ``lnum - 2`` (0-based) are missing.
+        if len(stacks) < lnum - 1:
+            stack = stacks[-1] if stacks else ()
+            for line in buffer[len(stacks):lnum - 1]:
+                stack = self._scan_envs(stack, (line,), markdown)
+                stacks.append(stack)
+        return self._scan_envs(stacks[lnum - 2] if lnum > 1 else (),
+                               (cinput,), markdown)
+
+    def _guess_mode(self, cinput, buffer_id=None, lnum=None):
+        """Tell math from text without the editor, by the environments
+        open and the ``$``, ``\\(`` and ``\\[`` delimiters in ``cinput``.
+        Math spanning lines is only caught for environments and, in math
+        buffers, ``$$`` blocks.
+        """
+        stack = self._env_stack(buffer_id, lnum, cinput)
+        if stack and stack[-1] == '```':
+            return 'text'
+        if any(env in MATH_ENVS for env in stack):
+            return 'math'
+        # Line breaks, e.g., ``\\[2pt]``, and ``\$`` aren't delimiters.
+        line = re.sub(r'(?<!\\)%.*', '', cinput).replace('\\\\', '')
+        line = line.replace('\\$', '')
+        if buffer_id in self._math_buffers:
+            # Pandoc's rules: no space inside a ``$`` and no digit after
+            # the closing one, so prices aren't math. Unclosed, a ``$``
+            # followed by a digit is taken for a price too.
+            line = self._md_code_RE.sub('', line).replace('$$', '')
+            line = self._md_math_RE.sub('', line)
+            if self._md_open_RE.search(line):
+                return 'math'
+        elif line.replace('$$', '$').count('$') % 2:
+            return 'math'
+        for opener, closer in (('\\(', '\\)'), ('\\[', '\\]')):
+            if line.rfind(opener) > line.rfind(closer):
+                return 'math'
+        return 'text'
+
+    def _scan_envs(self, stack, lines, markdown=False):
+        """Apply the ``\\begin`` and ``\\end`` found in ``lines`` to a
+        tuple of open environments. Lines without any return the very same
+        tuple, so per-line stacks share storage. With ``markdown``, code
+        blocks and ``$$`` math blocks count as environments, "```" and
+        "$$", and code is skipped.
+        """
+        for line in lines:
+            if markdown:
+                if line.lstrip().startswith(('```', '~~~')):
+                    stack = (stack[:-1] if stack and stack[-1] == '```' else
+                             stack + ('```',))
+                    continue
+                if stack and stack[-1] == '```':
+                    continue
+                if '$$' in line:
+                    line = self._md_code_RE.sub('', line)
+                    for _ in range(line.count('$$')):
+                        stack = (stack[:-1] if stack and stack[-1] == '$$'
+                                 else stack + ('$$',))
+            if '\\' not in line:
+                continue
+            if '%' in line:
+                line = re.sub(r'(?<!\\)%.*', '', line)
+            found = self._env_RE.findall(line)
+            if not found:
+                continue
+            stack = list(stack)
+            for kind, env in found:
+                if kind == 'begin':
+                    stack.append(env)
+                elif env in stack:
+                    # Also drops anything left unclosed inside it.
+                    del stack[len(stack) - 1 - stack[::-1].index(env):]
+            stack = tuple(stack)
+        return stack
+
+    def _gather_paths(self, cmd, complete_str, buffer_id):
+        """Offer files and subdirectories for a file-name argument. The
+        typed directory part is resolved against the buffer's directory and,
+        for ``\\includegraphics``, each ``\\graphicspath`` entry.
+        """
+        exts, implicit_ext = self._path_cmds[cmd]
+        # Keep everything typed before the last separator in each word.
+        head = complete_str[:max(complete_str.rfind(c) for c in ',/') + 1]
+        dirpart = head.rpartition(',')[-1]
+        bufdir = os.path.dirname(self.editor.path(buffer_id)) or os.curdir
+        bases = [bufdir]
+        if cmd == 'includegraphics':
+            bases += [os.path.join(bufdir, g) for g in
+                      self._graphicspaths.get(buffer_id, ())]
+        out = {}
+        for base in bases:
+            dirpath = os.path.join(base, os.path.expanduser(dirpart))
+            for name, is_dir in self._list_dir(dirpath):
+                if name.startswith('.'):
+                    continue
+                if is_dir:
+                    out.setdefault(head + name + '/', 'dir')
+                    continue
+                stem, ext = os.path.splitext(name)
+                if exts is not None and ext.lower() not in exts:
+                    continue
+                if implicit_ext and ext.lower() == implicit_ext:
+                    name = stem
+                out.setdefault(head + name, 'file')
+        return [{'word': word, 'abbr': word[len(head):], 'kind': kind} for
+                word, kind in sorted(out.items(),
+                                     key=lambda i: (i[1], i[0].lower()))]
+
+    def _list_dir(self, dirpath):
+        """Return ``[(name, is_dir), ...]`` for a directory. Listings are
+        cached until the directory's mtime changes, so a single ``stat``
+        is all a keystroke costs.
+        """
+        try:
+            mtime = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            return []
+        cached = self._dir_cache.get(dirpath)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with os.scandir(dirpath) as it:
+                listing = [(e.name, e.is_dir()) for e in it]
+        except OSError:
+            listing = []
+        self._dir_cache[dirpath] = (mtime, listing)
+        return listing
+
+    def _find_graphicspath(self, preamble):
+        gp_RE = re.compile(r'^\s*\\graphicspath\s*{((?:\s*{[^}]*})*)\s*}')
+        for line in preamble:
+            m = gp_RE.match(line)
+            if m:
+                return re.findall(r'{([^}]*)}', m.group(1))
+        return []
+
+    def _find_packages(self, preamble):
+        up_RE = re.compile(r'^\s*\\(usepackage|documentclass)'
+                           r'(?:\[(.*?)\]\s?)?{([^}]+)}')
+        for line in preamble:
+            m = up_RE.match(line)
+            if m:
+                yield (self._class_names.get(m.group(3), m.group(3)) if
+                       'class' in m.group(1) else m.group(3)), m.group(2)
+
+    def _project_root(self, fpath):
+        """Return the nearest directory above ``fpath`` holding VCS or
+        latexmk files, else its own directory.
+        """
+        start = os.path.dirname(os.path.abspath(fpath or os.curdir))
+        path = start
+        while True:
+            if any(os.path.exists(os.path.join(path, marker)) for marker in
+                   ('.git', '.hg', '.svn', 'latexmkrc', '.latexmkrc')):
+                return path
+            parent = os.path.dirname(path)
+            if parent == path:
+                return start
+            path = parent
+
+    def _update_history(self, key, fpath):
+        """Count packages from this preamble, once per session, for the
+        buffer's project and globally, and remember the preamble itself,
+        local styles and their mtimes included, for prebuilding its
+        universe next time. Bounded to the most used packages and most
+        recent projects.
+        """
+        if not self._history_max:
+            return
+        root = self._project_root(fpath)
+        projects = self._history['projects']
+        project = projects.pop(root, {})
+        projects[root] = project
+        counts = project.setdefault('packages', {})
+        project['key'] = sorted([name, args] for name, args in key)
+        project['local'] = {name: self._local_names[name] for name, _ in key
+                            if name in self._local_names}
+        for name, _ in key:
+            if (name in self._local_names or
+                    (root, name) in self._history_seen):
+                continue
+            self._history_seen.add((root, name))
+            for pool in (counts, self._history['global']):
+                pool[name] = pool.get(name, 0) + 1
+        for pool in (counts, self._history['global']):
+            for name in sorted(pool, key=pool.get)[:-self._history_max * 5]:
+                del pool[name]
+        for root in list(projects)[:-self._history_max]:
+            del projects[root]
+        self._save_cache('history.json', self._history)
+
+    def _prewarm(self, names, key=None, local=None):
+        """Build blocks for ``names`` and whatever they include, in a
+        background thread, then the universe for ``key``, if given. Local
+        styles in ``key`` are read from ``local``, their ``(fpath,
+        mtime)`` as last seen, unless they've changed since, in which case
+        the universe is left for the buffer to build. Work
+        pauses whenever a keystroke or event arrives, dropping the package
+        in progress, and resumes after ``_idle_delay`` idle seconds. Stops
+        short of the memory cap, checked against a rough estimate of each
+        block's footprint, or once ``_prewarm_secs`` of work is done.
+        """
+        def busy():
+            return (time.time() - self._last_activity < self._idle_delay or
+                    self._prewarm_stop.is_set())
+        #
+        # In order of likelihood, includes right after their includers.
+        pending = []
+        for name in names:
+            pending += [n for n in sorted(self._include_closure([name])) if
+                        n not in pending and n not in self._user_cwls]
+        used = spent = 0
+        while pending and not self._prewarm_stop.is_set():
+            name = pending[0]
+            if name in self._blocks:
+                pending.pop(0)
+                continue
+            if busy():
+                self._prewarm_stop.wait(self._idle_delay / 4)
+                continue
+            if spent > self._prewarm_secs:
+                break
+            started = time.time()
+            block = self._make_block(self._packages[name], name, busy)
+            spent += time.time() - started
+            if block is None:
+                continue
+            size = self._block_size(block)
+            if used + size > self._prewarm_cap:
+                break
+            used += size
+            with self._cache_lock:
+                self._blocks.setdefault(name, block)
+            pending.pop(0)
+        self.debug_enabled and self._whine(
+            'Prewarmed %.1fMiB of blocks in %.2fs, %d left' %
+            (used / 2**20, spent, len(pending)))
+        # Universes for keys with unloaded user cwl files or changed local
+        # styles would come out wrong.
+        if (key and not pending and not self._prewarm_stop.is_set() and
+                self._prewarm_local(local or {}) and
+                all(name in self._packages and name not in self._user_cwls
+                    for name, _ in key)):
+            generation, universe = self._make_current(key)
+            with self._cache_lock:
+                # Otherwise, some blocks it's made of were flushed since.
+                if generation == self._generation:
+                    self._prefetched[key] = universe
+
+    def _prewarm_local(self, local):
+        """Load the local styles in ``local``, ``{name: (fpath, mtime)}``,
+        unless the indexer already has. Return False if any changed or
+        went missing.
+        """
+        for name, (fpath, mtime) in local.items():
+            try:
+                if os.path.getmtime(fpath) != mtime:
+                    return False
+                if self._local_names.get(name) != (fpath, mtime):
+                    scanned, parsed = self._indexer._scan_local_style(fpath)
+                    if scanned != mtime:
+                        return False
+                    with self._cache_lock:
+                        self._packages[name] = parsed['data']
+                        self._local_names[name] = (fpath, mtime)
+            except OSError:
+                return False
+        return True
+
+    def _block_size(self, block):
+        """Estimate the memory taken by a block's items and collections.
+        Strings shared with the package data aren't counted.
+        """
+        return sum(sys.getsizeof(seq) + sum(sys.getsizeof(i) for i in seq)
+                   for seq in (block.math, block.text, block.envs))
+
+    def _update_usage(self, buffer_id, large=False):
+        """Fold the buffer's new command usage and any accepted completions
+        into the usage counts. Universes are re-ranked as they're rebuilt,
+        so none of this touches the keystroke path. Large buffers aren't
+        read, leaving their counts as last scanned. Return True if any
+        counts changed.
+        """
+        counts = (self._buffer_usage.get(buffer_id, Counter()) if large else
+                  Counter(self._usage_RE.findall(
+                      '\n'.join(self.editor.lines(buffer_id)))))
+        # Only count what's new since this buffer was last scanned.
+        delta = counts - self._buffer_usage.get(buffer_id, Counter())
+        delta.update(self._usage_pending)
+        self._buffer_usage[buffer_id] = counts
+        self._usage_pending = Counter()
+        if not delta:
+            return False
+        self._usage.update(delta)
+        if time.time() - self._usage_saved > 60:
+            self._save_usage()
+        return True
+
+    def _save_usage(self):
+        # Only the most common entries are worth keeping around.
+        self._save_cache('usage.json', dict(self._usage.most_common(2000)))
+        self._usage_saved = time.time()
+
+    def _find_user_cwls(self, paths):
+        """Map names of ``.cwl`` files in user directories to their paths.
+        Earlier directories win.
+        """
+        if isinstance(paths, str):
+            paths = paths.split(',')
+        found = {}
+        for cwl_dir in paths or ():
+            cwl_dir = os.path.expanduser(cwl_dir.strip())
+            if not os.path.isdir(cwl_dir):
+                continue
+            for entry in os.scandir(cwl_dir):
+                if entry.name.endswith('.cwl') and entry.is_file():
+                    found.setdefault(entry.name[:-len('.cwl')], entry.path)
+        return found
+
+    def _load_cache(self, fname, default=None):
+        return _read_json(os.path.join(self._cache_dir, fname), default)
+
+    def _save_cache(self, fname, data):
+        fpath = os.path.join(self._cache_dir, fname)
+        try:
+            _write_json(fpath, data)
+        except OSError as err:
+            self.debug_enabled and self._whine(
+                'Could not write %s: %r' % (fpath, err))
+
+    def _whine(self, *msg, dequote=False):
+        """Echo debug spam to the ``debug`` callable, if any."""
+        if self.debug_enabled:
+            if dequote is False:
+                self.debug(json.dumps(msg, indent=2).strip('[]'))
+            else:
+                out = (''.join(''.join(l.rsplit('"', 1)).rstrip(',').split(
+                    '"', 1)) for l in json.dumps(msg, indent=2).split('\n'))
+                self.debug('\n'.join(out).strip('[]'))
+        return None
+
+    def _make_options(self, opts, sigs, catname, packname=None):
+        """Return ``dict(slots=..., **fields)`` for an entry's arg fields.
+        ``slots`` has a tuple of ``(bracket, field)`` pairs per signature,
+        one pair per argument, for ``_match_slot``.
+        """
+        # Placeholder words telling which argument takes which field.
+        tokens = dict(keyvals=('keyval', 'option', 'key'))
+        if isinstance(sigs, (str, StrRef)) or not sigs:
+            sigs = [sigs or '']
+        slots = []
+        for sig in map(str, sigs):
+            args = self._split_sig(sig)
+            if catname == 'environments':
+                # Drop the ``{name}`` of ``\\begin{name}``.
+                args = args[1:]
+            pairs = [(bracket, next((f for f in opts if any(
+                t in text.lower() for t in tokens.get(f, (f,)))), None)) for
+                     bracket, text in args]
+            if not any(f for _, f in pairs) and 'keyvals' in opts:
+                # E.g., ``\\smashoperator[pos]{...}``. First optional arg,
+                # else first mandatory one.
+                idx = next((n for n, (b, _) in enumerate(pairs) if b == '['),
+                           0 if pairs else None)
+                if idx is None:
+                    pairs = [('[', 'keyvals')]
+                else:
+                    pairs[idx] = (pairs[idx][0], 'keyvals')
+            slots.append(tuple(pairs))
+        fields = {}
+        for field, values in opts.items():
+            if field == 'keyvals':
+                values = self._make_keyvals(values, packname)
+            elif values is not None:
+                values = tuple(self._make_item(v, {}, 'options', packname) for
+                               v in values)
+            fields[field] = values
+        return dict(slots=tuple(slots), **fields)
+
+    def _split_sig(self, sig):
+        """Return ``(bracket, text)`` for each argument in a signature. Only
+        the bracket opening an argument counts toward nesting, so
+        ``[%<précision(s)%>]`` is one argument.
+        """
+        args, i = [], 0
+        while i < len(sig):
+            opener = sig[i]
+            if opener in '[{(':
+                closer = ']})'['[{('.index(opener)]
+                depth, j = 0, i
+                while j < len(sig):
+                    if sig[j] == opener:
+                        depth += 1
+                    elif sig[j] == closer:
+                        depth -= 1
+                        if not depth:
+                            break
+                    j += 1
+                args.append((opener, sig[i + 1:j]))
+                i = j
+            i += 1
+        return args
+
+    def _make_keyvals(self, entries, packname=None):
+        kind = packname + ' opt' if packname else 'option'
+        keys, values = {}, {}
+        for entry in entries:
+            if entry.startswith('%'):
+                # Refers to a list defined elsewhere in the cwl.
+                continue
+            key, eq, hash_, rest = self._keyval_RE.match(entry).groups()
+            key = key.strip()
+            hints = re.findall(r'%<([^%]*)%>', rest)
+            if hash_ and rest.startswith('#'):
+                # Value type, e.g., ``L`` for lengths.
+                hints.append(rest[1:])
+            elif hash_ and rest.startswith('%'):
+                values[key] = rest[1:]
+            elif hash_:
+                vals = [v for v in self._split_values(rest) if
+                        '%<' not in v]
+                values[key] = tuple({'word': v, 'kind': kind} for v in vals)
+            item = {'word': key + eq, 'kind': kind}
+            if hints:
+                item.update(abbr='%s%s<%s>' % (key, eq or '=', hints[0]))
+            if isinstance(values.get(key), tuple):
+                item.update(menu='|'.join(v['word'] for v in values[key]))
+            keys.setdefault(key, item)
+        return Keyvals(tuple(sorted(keys.values(),
+                                    key=lambda i: i['word'].lower())),
+                       values)
+
+    def _split_values(self, text):
+        """Split on commas outside braces."""
+        out, depth, start = [], 0, 0
+        for i, c in enumerate(text):
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+            elif c == ',' and not depth:
+                out.append(text[start:i])
+                start = i + 1
+        out.append(text[start:])
+        return [v for v in out if v]
+
+    def _make_item(self, entname, entdata, catname, packname=None):
+        # Get abbreviated category ("kind") name.
+        kshrt = self._cat2kind[catname]
+        ksing = self._plur2sing.setdefault(catname, catname.rstrip('s'))
+        # All entries get one of these:
+        complete_dct = {'kind': packname + ' ' + kshrt if packname else ksing,
+                        'word': entname}
+        if catname == 'options':
+            lhs, _, rhs = entname.partition('#')
+            if rhs:
+                rhs = ' (' + rhs.replace(',', ', ') + ')'
+                complete_dct.update(word=lhs, abbr=(lhs + rhs))
+        # For now, use whatever sig comes first if more than one.
+        try:
+            sig = entdata.get('sig')
+        except AttributeError:
+            sig = None
+        else:
+            if sig:
+                sig = sig[0] if hasattr(sig, '__setitem__') else sig
+        # Check for argument-fields data under ``options`` in ``meta``.
+        try:
+            opts = entdata.get('meta', {}).get('options')
+        except AttributeError:
+            opts = None
+        #
+        if catname == 'commands':
+            # Append vimtex hotkey mapping to symbol if available.
+            if self._vimtex_maps and entname in self._vimtex_maps:
+                vt = '\t(' + self._vimtex_maps[entname] + ')'
+            else:
+                vt = ''
+            symbol = entdata['symbol'] + vt if entdata.get('symbol') else vt
+            complete_dct.update(menu=symbol)
+            # ``abbr`` is for display purposes only...
+            if sig:
+                complete_dct.update(abbr=sig)
+            # Add args/options if present.
+            if opts:
+                # Create a fake/standin signature if none provided.
+                if not entdata['sig']:
+                    newsig = entname + ''.join('[%s]' % o for o in opts)
+                    entdata.update(sig=newsig)
+                    complete_dct.update(abbr=entdata['sig'])
+        #
+        if catname == 'environments' and sig:
+            fields = str(sig).partition('}')[-1]
+            if fields:
+                complete_dct.update(abbr=(entname + ' ' + fields))
+        try:
+            # Some info values are tuples with multiple signatures. Those
+            # from a pack are left encoded, see ``_resolve``.
+            infostr = (entdata['info'] if
+                       isinstance(entdata['info'], (str, StrRef,
+                                                    type(None))) else
+                       '\n'.join(entdata['info']))
+        except (KeyError, TypeError):
+            pass
+        else:
+            # Cannot be ``None``, otherwise "null" appears in preview window...
+            if infostr:
+                complete_dct.update(info=infostr)
+        return complete_dct
+
+    def _get_block(self, packname):
+        """Return the (cached) block for a package, ``None`` for the base
+        ``latex-*`` defs.
+        """
+        block = self._blocks.get(packname)
+        if block is None:
+            block = self._make_block(
+                self._cats if packname is None else self._packages[packname],
+                packname)
+            with self._cache_lock:
+                block = self._blocks.setdefault(packname, block)
+        return block
+
+    def _get_arg_pools(self, packname, arg):
+        """Return the (cached) shared option pools unlocked by passing
+        ``arg`` to a package, as sorted items by pool name.
+        """
+        source = self._packages[packname]
+        cached = self._arg_pools.get((packname, arg))
+        if cached is not None and cached[0] is source:
+            return cached[1]
+        po_pool = (source.get('options') or {}).get('\\usepackage')
+        pools = {}
+        if isinstance(po_pool, dict) and arg:
+            for optname, optlist in (po_pool.get(arg) or {}).items():
+                if optlist:
+                    pools[optname] = tuple(sorted(
+                        (self._make_item(o, {}, 'options') for o in
+                         set(optlist)), key=lambda i: i['word'].lower()))
+        with self._cache_lock:
+            self._arg_pools[packname, arg] = (source, pools)
+        return pools
+
+    def _make_block(self, cats, packname=None, interrupt=None):
+        """Return a block for a package's categories. If ``interrupt``
+        returns true, which is polled every so often, give up and return
+        None.
+        """
+        # Key for ``list.sort()`` below...
+        def key(item):
+            return item.get('word').lower()
+        #
+        math, text, envs, options = [], [], [], {}
+        envcmds, env_aliases = {}, {}
+        for catname in ('commands', 'environments'):
+            for n, (entname, entdata) in enumerate(
+                    (cats.get(catname) or {}).items()):
+                if interrupt and not n % 128 and interrupt():
+                    return None
+                complete_dct = self._make_item(entname, entdata,
+                                               catname, packname)
+                meta = entdata.get('meta') or {}
+                # Args/options. If an option's value is None, it's a
+                # "shared" option, looked up per universe.
+                opts = meta.get('options')
+                if opts:
+                    options[entname] = self._make_options(
+                        opts, entdata['sig'], catname, packname)
+                if catname == 'environments':
+                    envs.append(complete_dct)
+                    if meta.get('env_aliases'):
+                        env_aliases[entname] = tuple(meta['env_aliases'])
+                    continue
+                for env in meta.get('environments') or ():
+                    envcmds.setdefault(env, set()).add(entname)
+                if 'math' in entdata['mode']:
+                    math.append(complete_dct)
+                if 'text' in entdata['mode']:
+                    text.append(complete_dct)
+        return Block(cats, *(tuple(sorted(l, key=key)) for l in
+                             (math, text, envs)), options,
+                     {env: frozenset(cmds) for env, cmds in envcmds.items()},
+                     env_aliases)
+
+    def _universe(self, buffer_id, timeout=None):
+        """Return the universe assigned to a buffer, assembling it from
+        package blocks if it isn't cached. With a latency budget, assembly
+        happens in a worker thread, and None is returned if it isn't done
+        within ``timeout`` seconds. Universes assembled from blocks flushed
+        in the meantime are discarded. See ``_make_current``.
+        """
+        key = self._buffer_keys.get(buffer_id, frozenset())
+        universe = self._universes.get(key)
+        if universe is not None:
+            self._universes.move_to_end(key)
+            return universe
+        # Possibly prebuilt at startup from the project's last preamble.
+        with self._cache_lock:
+            universe = self._prefetched.pop(key, None)
+        if universe is None and self._budget:
+            future = self._building.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = futures.ThreadPoolExecutor(1)
+                future = self._building[key] = self._executor.submit(
+                    self._make_current, key)
+            try:
+                generation, universe = future.result(timeout)
+            except futures.TimeoutError:
+                return None
+            finally:
+                if future.done() and self._building.get(key) is future:
+                    del self._building[key]
+            if generation != self._generation:
+                if timeout is not None:
+                    return None
+                universe = None
+        if universe is None:
+            universe = self._make_universe(key)
+        self._universes[key] = universe
+        while len(self._universes) > self._universes_max:
+            self._universes.popitem(last=False)
+        return universe
+
+    def _make_current(self, key):
+        """Return the cache generation, then a universe made for ``key``.
+        For use off the main thread, where flushes happen.
+        """
+        return self._generation, self._make_universe(key)
+
+    def _include_closure(self, names):
+        """Return known packages among ``names`` plus everything they
+        include, recursively. Base ``latex-*`` defs are always present, so
+        they're left out.
+        """
+        loaded = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if (name in loaded or name not in self._packages or
+                    name.startswith('latex')):
+                continue
+            loaded.add(name)
+            pending.extend(self._packages[name].get('includes') or ())
+        return loaded
+
+    def _make_universe(self, key):
+        def key_func(item):
+            return item.get('word').lower()
+        #
+        loaded = self._include_closure(name for name, _ in key)
+        names = ('latex',) + self._extras + tuple(sorted(loaded))
+        blocks = [self._get_block(None)]
+        blocks += [self._get_block(name) for name in names[1:]]
+        # Priority tiers: the document's packages, then base defs, then
+        # the optional extras, e.g., MathJax-only macros.
+        tiers = dict.fromkeys(loaded, 0)
+        tiers.update(dict.fromkeys(self._extras, 2), latex=1)
+        #
+        # Package args may unlock "shared" options, e.g., xcolor colors.
+        # Currently, class options don't unlock any. Since the args are
+        # part of the key, dropping one drops its pool right away.
+        found = {}
+        for name, args in sorted(key, key=lambda pair: (pair[0],
+                                                        pair[1] or '')):
+            if not args or name.startswith('class'):
+                continue
+            for parg in args.split(','):
+                for pool, items in self._get_arg_pools(name,
+                                                       parg.strip()).items():
+                    found.setdefault(pool, []).append(items)
+        shared = {}
+        for pool, runs in found.items():
+            items, seen = [], set()
+            for item in heapq.merge(*runs, key=key_func):
+                if item['word'] not in seen:
+                    seen.add(item['word'])
+                    items.append(item)
+            shared[pool] = tuple(items)
+        options = {}
+        for block in blocks:
+            options.update(block.options)
+        #
+        # Already loaded packages (and classes) aren't offered again.
+        base = blocks[0].source
+        packs = [self._make_item(p, d, 'packages') for p, d in
+                 sorted(base['packages'].items()) if p not in loaded]
+        clss = [self._make_item(c, d, 'classes') for c, d in
+                sorted(base['classes'].items()) if
+                self._class_names[c] not in loaded]
+        envcmds, env_aliases = {}, {}
+        for block in blocks:
+            env_aliases.update(block.env_aliases)
+            for env, cmds in block.envcmds.items():
+                envcmds[env] = envcmds.get(env, frozenset()) | cmds
+        # Environment-only commands go last, except when inside. Extra
+        # commands from ``_env_commands`` are valid elsewhere, too, and
+        # are looked up separately. See ``_rank_for_envs``.
+        env_only = frozenset().union(*envcmds.values())
+        lists = [self._dedupe(heapq.merge(
+            *(zip(getattr(b, attr), itertools.repeat(name)) for b, name in
+              zip(blocks, names)), key=lambda pair: key_func(pair[0])), tiers)
+                 for attr in ('math', 'text', 'envs')]
+        # By tier, then most used first. Sorting is stable, so ties stay
+        # alphabetical. Nothing is sorted per keystroke.
+        usage = self._usage or {}
+        for ranked in lists[:2]:
+            ranked.sort(key=lambda p: (p[0], p[1]['word'] in env_only,
+                                       -usage.get(p[1]['word'], 0)))
+        lists[2].sort(key=lambda p: (p[0], -usage.get(p[1]['word'], 0)))
+        return Universe(*(tuple(i for _, i in ranked) for ranked in lists),
+                        tuple(sorted(packs, key=key_func)),
+                        tuple(sorted(clss, key=key_func)), options, shared,
+                        envcmds, env_aliases, {})
+
+    def _resolve(self, cands):
+        """Return a list of ``cands`` with ``StrRef`` fields decoded.
+        Decoded copies are kept, so only items actually offered ever take
+        up memory as strings, and only once.
+        """
+        if not isinstance(self._packages, PackedStore):
+            return list(cands)
+        resolved = self._resolved
+        if len(resolved) > 20000:
+            # Mostly one-off tuples, e.g., last good candidates. Start over.
+            resolved.clear()
+        # Universe snapshots are tuples, which come up again and again.
+        if type(cands) is tuple:
+            entry = resolved.get(('tuple', id(cands)))
+            if entry is None:
+                entry = resolved[('tuple', id(cands))] = (
+                    cands, self._resolve(list(cands)))
+            return list(entry[1])
+        out = []
+        for item in cands:
+            if (type(item.get('abbr')) is StrRef or
+                    type(item.get('info')) is StrRef):
+                entry = resolved.get(id(item))
+                if entry is None:
+                    copy = dict(item)
+                    for field in ('abbr', 'info'):
+                        if type(copy.get(field)) is StrRef:
+                            copy[field] = str(copy[field])
+                    # Holding on to the item keeps its id from being reused.
+                    entry = resolved[id(item)] = (item, copy)
+                item = entry[1]
+            out.append(item)
+        return out
+
+    def _dedupe(self, pairs, tiers):
+        """Collapse ``(item, package)`` pairs, sorted case-insensitively,
+        into a list of ``(tier, item)`` with one item per word, ranked by
+        the best of its packages' ``tiers``. Words from several packages
+        get a merged item: the first package's, with their names in
+        ``kind`` and gaps filled from the others.
+        """
+        out = []
+        for _, group in itertools.groupby(
+                pairs, key=lambda pair: pair[0]['word'].lower()):
+            by_word = OrderedDict()
+            for item, name in group:
+                by_word.setdefault(item['word'], []).append((item, name))
+            for found in by_word.values():
+                out.append((min(tiers[name] for _, name in found),
+                            found[0][0] if len(found) == 1 else
+                            self._merge_items(found)))
+        return out
+
+    def _merge_items(self, found):
+        ids = tuple(id(item) for item, _ in found)
+        entry = self._merged.get(ids)
+        if entry is None:
+            first = found[0][0]
+            merged = dict(first)
+            # E.g., "command" plus amsmath's "amsmath cmd".
+            kshrt = first['kind'].rpartition(' ')[-1]
+            kshrt = self._cat2kind.get(kshrt + 's', kshrt)
+            merged['kind'] = '%s %s' % (
+                ','.join(OrderedDict.fromkeys(n for _, n in found)), kshrt)
+            for item, _ in found[1:]:
+                for field in ('abbr', 'menu', 'info'):
+                    if item.get(field) and not merged.get(field):
+                        merged[field] = item[field]
+            # Keep the merged items alive, so their ids aren't reused.
+            with self._cache_lock:
+                entry = self._merged.setdefault(
+                    ids, (merged, [i for i, _ in found]))
+        return entry[0]
+
+    def _make_lists(self):
+        """Load package data and sort out the base categories from which
+        every universe is assembled. See ``_make_universe``.
+        """
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        # This path is hard-coded, but likely won't change...
+        self._resources_dir = os.path.join(module_dir, 'resources')
+        fpath = os.path.join(self._resources_dir, 'latest.json')
+        self._packages = (self._open_store(fpath) if
+                          self._storage == 'sqlite' else
+                          self._open_pack(fpath) if
+                          self._storage == 'pack' else None)
+        if self._packages is None:
+            with open(fpath) as f:
+                self._packages = json.load(f)
+        packages = self._packages
+        #
+        # Stand-ins for user cwl files until they're referenced.
+        for name, cwl_fpath in self._user_cwls.items():
+            if not name.startswith('latex') and name not in packages:
+                packages[name] = dict(info='User cwl: %s' % cwl_fpath)
+        #
+        # Lookups based on cwl filenames are unwieldy for classes, e.g.,
+        # ``class-foo,bar``. Need crutch like ``{"foo": "class-foo,bar", ...}``
+        class_names = (set.union(*({(short, long)} for short in
+                                   long.partition('-')[-1].split(','))) for
+                       long in packages if long.startswith('class'))
+        self._class_names = dict(set.union(*class_names))
+        #
+        self._start_indexer(self._index_worker)
+        # Base ``latex-*`` defs are merged below, so user files overriding
+        # those are parsed right away, in-process.
+        for name in self._user_cwls:
+            if name.startswith('latex'):
+                delta = dict(cwls={}, log=[])
+                self._indexer.load_user_cwl(name, delta)
+                self._index_deltas.append(delta)
+        self._apply_index()
+        #
+        # Initialize base lists of completion items by category (kind).
+        cats = self._cats = {}
+        cats['classes'] = {short: {'info': self._package_info(long)} for
+                           short, long in self._class_names.items()}
+        #
+        cats['packages'] = {p: {'info': self._package_info(p)} for p in
+                            packages if not any(p.startswith(s) for s in
+                                                ('class', 'misc', 'latex'))}
+        #
+        # Also add "base" defs from texstudio's ``completion`` directory. At
+        # the time of this first commit, these are: 'latex-l2tabu',
+        # 'latex-209', 'latex-dev', 'latex-mathsymbols', 'latex-document'
+        cat_kinds = 'classes packages commands environments options'.split()
+        cats.update(zip(cat_kinds[-3:], ({}, {}, {})))
+        #
+        for pname in packages:
+            if not pname.startswith('latex'):
+                continue
+            for catname, catdata in packages[pname].items():
+                if catname not in cats or not catdata:
+                    continue
+                # ``ent*`` as in "entry"...
+                for entname, entdata in catdata.items():
+                    cats[catname].update({entname: entdata})
+        #
+        self._plur2sing = {'classes': 'class'}
+        self._cat2kind = dict(zip(cat_kinds, 'cls pkg cmd env opt'.split()))
+
+    def _open_store(self, json_fpath):
+        """Return a ``PackageStore`` for the database, preferring one
+        built by the resources pipeline. Otherwise, one is built in the
+        cache dir when missing or older than ``latest.json``.
+        """
+        mtime = os.path.getmtime(json_fpath)
+        for fpath in (os.path.join(self._resources_dir, 'latest.sqlite3'),
+                      os.path.join(self._cache_dir, 'latest.sqlite3')):
+            if os.path.exists(fpath) and os.path.getmtime(fpath) >= mtime:
+                break
+        else:
+            try:
+                os.makedirs(self._cache_dir, exist_ok=True)
+                with open(json_fpath) as f:
+                    _import_resource(self._resources_dir,
+                                     'make_sqlite').build(json.load(f), fpath)
+            except (OSError, sqlite3.Error) as err:
+                self.debug_enabled and self._whine(
+                    'Could not build %s: %r' % (fpath, err))
+                return None
+        try:
+            # Universes may be assembled in a worker thread.
+            return PackageStore(sqlite3.connect(fpath,
+                                                check_same_thread=False))
+        except sqlite3.Error as err:
+            self.debug_enabled and self._whine(
+                'Could not open %s: %r' % (fpath, err))
+            return None
+
+    def _open_pack(self, json_fpath):
+        """Return a ``PackedStore``, preferring a pack built by the
+        resources pipeline. Otherwise, one is built in the cache dir when
+        missing, older than ``latest.json`` or of an older format.
+        """
+        mtime = os.path.getmtime(json_fpath)
+        for fpath in (os.path.join(self._resources_dir, 'latest.pack'),
+                      os.path.join(self._cache_dir, 'latest.pack')):
+            if os.path.exists(fpath) and os.path.getmtime(fpath) >= mtime:
+                try:
+                    return PackedStore(fpath)
+                except (OSError, ValueError) as err:
+                    self.debug_enabled and self._whine(
+                        'Could not open %s: %r' % (fpath, err))
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(json_fpath) as f:
+                _import_resource(self._resources_dir,
+                                 'compact_json').pack(json.load(f), fpath)
+            return PackedStore(fpath)
+        except (OSError, ValueError) as err:
+            self.debug_enabled and self._whine(
+                'Could not build %s: %r' % (fpath, err))
+            return None
+
+    def _open_cmd_index(self):
+        """Return the reverse command index, preferring one built by the
+        resources pipeline. Otherwise, one is built in the cache dir when
+        missing or older than ``latest.json``.
+        """
+        json_fpath = os.path.join(self._resources_dir, 'latest.json')
+        try:
+            mtime = os.path.getmtime(json_fpath)
+        except OSError:
+            mtime = 0
+        for fpath in (os.path.join(self._resources_dir, 'cmd_index.json'),
+                      os.path.join(self._cache_dir, 'cmd_index.json')):
+            if os.path.exists(fpath) and os.path.getmtime(fpath) >= mtime:
+                index = _read_json(fpath)
+                if isinstance(index, dict):
+                    return index
+                self.debug_enabled and self._whine(
+                    'Could not read %s' % fpath)
+        try:
+            with open(json_fpath) as f:
+                index = _import_resource(self._resources_dir,
+                                         'make_cmd_index').make_index(
+                                             json.load(f))
+            _write_json(fpath, index)
+            return index
+        except (OSError, ValueError) as err:
+            self.debug_enabled and self._whine(
+                'Could not build %s: %r' % (fpath, err))
+            return {}
+
+    def _package_info(self, name):
+        if isinstance(self._packages, PackageStore):
+            return self._packages.info(name)
+        return self._packages[name].get('info')
+
+    def _iter_commands(self):
+        """Yield ``(package, cmd, entry)`` for all commands, base defs
+        first.
+        """
+        if isinstance(self._packages, PackageStore):
+            yield from sorted(self._packages.iter_commands(),
+                              key=lambda t: not t[0].startswith('latex'))
+            return
+        for packname in sorted(self._packages,
+                               key=lambda p: not p.startswith('latex')):
+            for cmd, cdata in (self._packages[packname].get('commands') or
+                               {}).items():
+                yield packname, cmd, cdata
+
+    def _make_symbol_index(self):
+        """Index commands by glyph and by the words in their unicode names,
+        for ``_match_symbols``. Names come from ``unicodedata`` and from the
+        "Unicode name" and "Speaktext" notes baked into ``info``. Words are
+        kept sorted, with postings alongside, for prefix lookups.
+        """
+        name_RE = re.compile(r'(?:Unicode name|Speaktext): "([^"]+)"')
+        # ``{cmd: (symbol, name, package)}``; base defs win.
+        self._symbols = symbols = {}
+        for packname, cmd, cdata in self._iter_commands():
+            if cmd in symbols or packname.startswith('class'):
+                continue
+            symbol = cdata.get('symbol') or ''
+            name_m = name_RE.search(_text(cdata.get('info')) or '')
+            name = name_m.group(1) if name_m else ''
+            if len(symbol) == 1 and ord(symbol) > 0x7f:
+                name = name or unicodedata.name(symbol, '')
+            elif not name:
+                continue
+            symbols[cmd] = (symbol, name,
+                            None if packname.startswith(('latex', 'misc')) else
+                            packname)
+        glyphs, index = {}, {}
+        for cmd, (symbol, name, _) in symbols.items():
+            if len(symbol) == 1 and ord(symbol) > 0x7f:
+                glyphs.setdefault(symbol, []).append(cmd)
+            for word in re.findall(r'\w+', name.lower()):
+                index.setdefault(word, []).append(cmd)
+        self._glyphs = {g: tuple(c) for g, c in glyphs.items()}
+        words = sorted(index)
+        self._uninames = (tuple(words), tuple(tuple(index[w]) for w in words))
+
+
+def socket_path(setting=None):
+    """Return the daemon's address: ``setting`` if it's a path, else a
+    per-user socket in the runtime dir or, lacking one, in a private
+    directory under the temp dir.
+    """
+    if isinstance(setting, str) and setting:
+        return os.path.expanduser(setting)
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'deoplete-latex-%d.sock' %
+                            os.getuid())
+    dirpath = os.path.join(tempfile.gettempdir(),
+                           'deoplete-latex-%d' % os.getuid())
+    try:
+        os.makedirs(dirpath, mode=0o700, exist_ok=True)
+    except OSError:
+        pass
+    # Whoever owns it, the socket's owner is checked before use.
+    return os.path.join(dirpath, 'daemon.sock')
+
+
+def _check_owner(address):
+    """Raise ``PermissionError`` unless the socket at ``address`` belongs
+    to the current user, lest another user's listener get the buffers.
+    """
+    if os.stat(address).st_uid != os.getuid():
+        raise PermissionError('Socket %s belongs to another user' % address)
+
+
+def _source_vars(vars):
+    """Return the settings among an editor's ``vars`` that ``Engine``
+    reads, so unrelated ones don't split editors among daemon engines.
+    """
+    return {name: value for name, value in vars.items() if
+            name.startswith('deoplete#sources#latex#')}
+
+
+class RemoteEngine:
+    """Same as ``Engine``, but hosted by a daemon shared among editors,
+    which is started if it isn't running. Requests and replies are a line
+    of json each. Buffers are sent by ``set_packages``, whole unless large,
+    so the daemon's view of lines above the cursor, for open environments,
+    dates from the last event. Large buffers are sent as an excerpt: the
+    lines a preamble is searched for and those around the last cursor line
+    seen. Candidate lists are cached, by a version the daemon assigns to
+    each, and only sent when new to this client. When the daemon can't be
+    reached, started or stops answering, an in-process ``Engine`` takes
+    over. Requests it fails on get empty replies instead, see ``_call``.
+    """
+
+    def __init__(self, editor, debug=None, address=None):
+        self.editor = editor
+        self.debug = debug
+        self.address = address or socket_path()
+        self.timeout = 5
+        self.input_patterns = []
+        self._file = None
+        self._local = None
+        self._buffers = {}
+        self._large_buffers = set()
+        self._cursors = {}
+        # Candidate lists received, ``{version: candidates}``, most recently
+        # offered last. See ``complete``.
+        self._lists = OrderedDict()
+        self._lists_max = 16
+        # Set by the daemon. See ``set_packages``.
+        self._large_lines = self._scan_window = 0
+
+    def load(self, vars, fpath=None, vimtex_maps=None):
+        vars = _source_vars(vars)
+        self._load_args = (vars, fpath, vimtex_maps)
+        try:
+            self._connect()
+        except OSError as err:
+            self._fall_back(err)
+            return
+        # Loading takes a while if the daemon is new.
+        reply = self._call(op='load', vars=vars, path=fpath,
+                           vimtex_maps=vimtex_maps, timeout=60)
+        if reply is not None:
+            self.input_patterns = reply['input_patterns']
+            self._large_lines, self._scan_window = reply['excerpt']
+
+    def find_start(self, cinput, mode='text', buffer_id=None, lnum=None):
+        if lnum is not None:
+            self._cursors[buffer_id] = lnum
+        reply = self._call(op='find_start', buf=buffer_id, input=cinput,
+                           mode=mode, lnum=lnum, default={'start': -1})
+        if reply is None:
+            return self._local.find_start(cinput, mode, buffer_id, lnum)
+        return reply['start']
+
+    def complete(self, line, col, mode='text', buffer_id=None, lnum=None):
+        if lnum is not None:
+            self._cursors[buffer_id] = lnum
+        reply = self._call(op='complete', buf=buffer_id, line=line, col=col,
+                           mode=mode, lnum=lnum, known=list(self._lists),
+                           default=dict(start=-1, candidates=[],
+                                        version=None, pending=False,
+                                        delegate=False))
+        if reply is None:
+            return self._local.complete(line, col, mode, buffer_id, lnum)
+        if reply['delegate']:
+            # The daemon would have asked the editor first.
+            cinput = line[:col]
+            delegated = self.editor.delegate(cinput, cinput[reply['start']:])
+            if delegated:
+                return Completion(reply['start'], delegated, False)
+        version = reply['version']
+        if 'candidates' in reply:
+            cands = reply['candidates']
+            if version is not None:
+                self._lists[version] = cands
+                while len(self._lists) > self._lists_max:
+                    self._lists.popitem(last=False)
+        else:
+            cands = self._lists[version]
+            self._lists.move_to_end(version)
+        return Completion(reply['start'], list(cands), reply['pending'])
+
+    def document(self, word, buffer_id=None):
+        reply = self._call(op='document', buf=buffer_id, word=word,
+                           default={'info': None})
+        if reply is None:
+            return self._local.document(word, buffer_id)
+        return reply['info']
+
+    def set_packages(self, buffer_id, preamble=None, math_only=False):
+        self._buffers[buffer_id] = math_only
+        buffer = self.editor.lines(buffer_id)
+        nlines = len(buffer)
+        excerpt = {}
+        if self._large_lines and nlines >= self._large_lines:
+            # What ``Engine`` reads of large buffers: the first lines, for
+            # the preamble, and those above the cursor, for environments.
+            # Lines below are for the cursor moving down before the next
+            # event.
+            window = self._scan_window
+            start = max(self._cursors.get(buffer_id, 1) - 1 - window, 0)
+            lines = list(buffer[:window])
+            excerpt = dict(nlines=nlines, window=[
+                start, list(buffer[start:start + 2 * window])])
+        else:
+            lines = list(buffer)
+        reply = self._call(op='set_packages', buf=buffer_id,
+                           path=self.editor.path(buffer_id), lines=lines,
+                           preamble=preamble and list(preamble),
+                           math_only=math_only,
+                           default={'large': buffer_id in
+                                    self._large_buffers}, **excerpt)
+        if reply is None:
+            self._local.set_packages(buffer_id, preamble, math_only)
+        elif reply['large']:
+            self._large_buffers.add(buffer_id)
+        else:
+            self._large_buffers.discard(buffer_id)
+
+    def large_buffer(self, buffer_id):
+        if self._local is not None:
+            return self._local.large_buffer(buffer_id)
+        return buffer_id in self._large_buffers
+
+    def record_completion(self, word):
+        if self._call(op='record_completion', word=word,
+                      default={}) is None:
+            self._local.record_completion(word)
+
+    def close(self):
+        if self._local is not None:
+            self._local.close()
+            return
+        # No point falling back on the way out.
+        try:
+            self._file.write(b'{"op":"close"}\n')
+            self._file.flush()
+            self._file.readline()
+            self._file.close()
+        except OSError:
+            pass
+
+    def drop_buffer(self, buffer_id):
+        self._buffers.pop(buffer_id, None)
+        self._cursors.pop(buffer_id, None)
+        if self._call(op='drop_buffer', buf=buffer_id, default={}) is None:
+            self._local.drop_buffer(buffer_id)
+
+    def _connect(self):
+        def attempt():
+            _check_owner(self.address)
+            sock = socket.socket(socket.AF_UNIX)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.address)
+            except OSError:
+                sock.close()
+                raise
+            return sock
+        #
+        try:
+            sock = attempt()
+        except PermissionError:
+            # Someone else's, or not ours to use. Starting a daemon won't
+            # help.
+            raise
+        except OSError:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              '--serve', self.address],
+                             stdin=subprocess.DEVNULL,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+            # Wait for it to listen.
+            for n in range(40):
+                time.sleep(0.05)
+                try:
+                    sock = attempt()
+                    break
+                except OSError:
+                    if n == 39:
+                        raise
+        self._file = sock.makefile('rwb')
+        self._sock = sock
+
+    def _call(self, timeout=None, default=None, **request):
+        """Send a request, return the reply. None means the in-process
+        engine is in charge, possibly as of this call. Only a broken or
+        silent connection causes that. Requests the daemon fails on are
+        logged and get ``default``, unless there is none, e.g., for
+        ``load``, without which the daemon has no engine to answer with.
+        """
+        if self._local is not None:
+            return None
+        try:
+            self._sock.settimeout(timeout or self.timeout)
+            self._file.write(json.dumps(request, separators=(',', ':'))
+                             .encode() + b'\n')
+            self._file.flush()
+            line = self._file.readline()
+            if not line:
+                raise OSError('Connection closed')
+            reply = json.loads(line.decode())
+        except (OSError, ValueError) as err:
+            self._fall_back(err)
+            return None
+        if 'error' in reply:
+            if default is None:
+                self._fall_back(reply['error'])
+                return None
+            self.debug and self.debug('Daemon failed on %r: %s' %
+                                      (request.get('op'), reply['error']))
+            return default
+        return reply
+
+    def _fall_back(self, err):
+        self.debug and self.debug(
+            'Daemon at %s unavailable, completing in-process: %r' %
+            (self.address, err))
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+        self._local = Engine(self.editor, self.debug)
+        self._local.load(*self._load_args)
+        self.input_patterns = self._local.input_patterns
+        for buffer_id, math_only in self._buffers.items():
+            self._local.set_packages(buffer_id, math_only=math_only)
+
+
+class _Excerpt(Sequence):
+    """A large buffer as sent by a client: ``nlines`` long, but only the
+    lines in ``chunks``, ``(start, lines)`` pairs, are known. The rest read
+    as blank.
+    """
+
+    def __init__(self, nlines, chunks):
+        self._nlines = nlines
+        self._chunks = chunks
+
+    def __len__(self):
+        return self._nlines
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._nlines))]
+        if index < 0:
+            index += self._nlines
+        if not 0 <= index < self._nlines:
+            raise IndexError(index)
+        for start, lines in self._chunks:
+            if start <= index < start + len(lines):
+                return lines[index - start]
+        return ''
+
+
+class _DaemonEditor(Headless):
+    """Buffers as last sent by clients. Delegating to an editor's own
+    completion is up to the client, so it's only noted here.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.delegated = False
+
+    def delegate(self, cinput, complete_str):
+        self.delegated = True
+        return None
+
+
+def serve(address, idle=600):
+    """Answer ``RemoteEngine`` clients on a unix socket at ``address``
+    until none has been connected for ``idle`` seconds. One engine is kept
+    per distinct configuration, so editors sharing a vimrc share an index.
+    Requests are handled one at a time.
+    """
+    import signal
+    import socketserver
+    #
+    if os.path.exists(address):
+        if os.stat(address).st_uid != os.getuid():
+            # Not ours to probe, let alone remove.
+            return
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(address)
+        except OSError:
+            # Left behind by a daemon that didn't exit cleanly.
+            os.remove(address)
+        else:
+            return
+        finally:
+            probe.close()
+    engines = {}
+    # Candidate tuples sent to clients, ``{id(cands): (cands, version)}``,
+    # most recent last. Holding on to them keeps their ids from being
+    # reused. Lists gathered afresh, e.g., file names, are always sent.
+    versions = OrderedDict()
+    version_ids = itertools.count()
+    lock = threading.Lock()
+    ids = itertools.count()
+    clients = dict(count=0, since=time.time())
+
+    def dispatch(engine, conn, op, request):
+        if op == 'load':
+            key = json.dumps([_source_vars(request['vars']),
+                              request['vimtex_maps']], sort_keys=True)
+            if key not in engines:
+                engines[key] = Engine(_DaemonEditor())
+                engines[key].load(request['vars'], request['path'],
+                                  request['vimtex_maps'])
+            return engines[key], {
+                'input_patterns': engines[key].input_patterns,
+                'excerpt': [engines[key]._large_lines,
+                            engines[key]._scan_window]}
+        bid = (conn, request.get('buf'))
+        if op == 'set_packages':
+            engine.editor.buffers[bid] = (
+                _Excerpt(request['nlines'], [(0, request['lines']),
+                                             tuple(request['window'])])
+                if 'window' in request else request['lines'])
+            engine.editor.paths[bid] = request['path']
+            engine.set_packages(bid, request['preamble'],
+                                request['math_only'])
+            return engine, {'large': engine.large_buffer(bid)}
+        if op == 'find_start':
+            return engine, {'start': engine.find_start(
+                request['input'], request['mode'], bid, request['lnum'])}
+        if op == 'complete':
+            engine.editor.delegated = False
+            start, cands, pending = engine._complete(
+                request['line'], request['col'], request['mode'], bid,
+                request['lnum'])
+            reply = dict(start=start, pending=pending, version=None,
+                         delegate=engine.editor.delegated)
+            if type(cands) is tuple:
+                entry = versions.pop(id(cands), None) or (cands,
+                                                          next(version_ids))
+                versions[id(cands)] = entry
+                while len(versions) > 64:
+                    versions.popitem(last=False)
+                reply['version'] = entry[1]
+                if entry[1] in request['known']:
+                    return engine, reply
+            reply['candidates'] = engine._resolve(cands)
+            return engine, reply
+        if op == 'document':
+            return engine, {'info': engine.document(request['word'], bid)}
+        if op == 'record_completion':
+            engine.record_completion(request['word'])
+        elif op == 'drop_buffer':
+            engine.drop_buffer(bid)
+            engine.editor.buffers.pop(bid, None)
+            engine.editor.paths.pop(bid, None)
+        elif op == 'close':
+            # Other clients may carry on, so only save.
+            engine._usage and engine._save_usage()
+        else:
+            raise ValueError('Unknown op: %r' % op)
+        return engine, {}
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            conn, engine = next(ids), None
+            with lock:
+                clients['count'] += 1
+            try:
+                for line in self.rfile:
+                    request = json.loads(line.decode())
+                    with lock:
+                        try:
+                            engine, reply = dispatch(
+                                engine, conn, request.pop('op'), request)
+                        except Exception as err:
+                            reply = {'error': repr(err)}
+                    self.wfile.write(json.dumps(reply, separators=(',', ':'))
+                                     .encode() + b'\n')
+            finally:
+                with lock:
+                    for bid in list(engine.editor.buffers if engine else ()):
+                        if bid[0] == conn:
+                            dispatch(engine, conn, 'drop_buffer',
+                                     {'buf': bid[1]})
+                    clients['count'] -= 1
+                    clients['since'] = time.time()
+
+    server = socketserver.ThreadingUnixStreamServer(address, Handler)
+    server.daemon_threads = True
+    os.chmod(address, 0o600)
+
+    def watch():
+        while True:
+            time.sleep(min(idle, 10))
+            with lock:
+                if (not clients['count'] and
+                        time.time() - clients['since'] > idle):
+                    break
+        server.shutdown()
+
+    threading.Thread(target=watch, daemon=True).start()
+    # Clean up when killed, too.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(address)
+        for engine in engines.values():
+            engine.close()
+
+
+def run_indexer(infile=sys.stdin, outfile=sys.stdout):
+    """Worker process loop for ``Engine._start_indexer``. The first line
+    holds ``Indexer`` args, the rest are requests. Replies are deltas, one
+    per line, in order.
+    """
+    indexer = Indexer(**json.loads(infile.readline()))
+    for line in infile:
+        request = json.loads(line)
+        try:
+            delta = indexer.handle(request)
+        except Exception as err:
+            delta = dict(id=request.get('id'),
+                         log=['Indexer failed: %r' % err])
+        outfile.write(json.dumps(delta) + '\n')
+        outfile.flush()
+
+
+if __name__ == "__main__":
+
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2])
+    elif sys.argv[1:2] == ['--index']:
+        run_indexer()
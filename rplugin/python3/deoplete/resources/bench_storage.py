@@ -0,0 +1,105 @@
+#!/bin/python3
+"""Compare start-up costs of the source's storage options: ``latest.json``
+read whole, versus packs compressed with zlib or lzma (see
+``compact_json.py``) and decompressed per package. For each, a fresh
+process loads the engine and a typical preamble's packages ("cold"), then
+does it all again ("warm"). Bytes read come from ``/proc/self/io``, where
+available, plus the pack's own tally of package data read through its
+memory map, which the former misses. Strings decoded from the map aren't
+counted.
+
+    $ ./bench_storage.py [runs]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import util
+
+PREAMBLE = ['\\documentclass{article}', '\\usepackage{amsmath}',
+            '\\usepackage{amssymb}', '\\usepackage{graphicx}',
+            '\\usepackage{hyperref}', '\\usepackage[svgnames]{xcolor}',
+            '\\begin{document}']
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_path(name, fpath):
+    spec = util.spec_from_file_location(name, fpath)
+    module = util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def rchar():
+    try:
+        with open('/proc/self/io') as f:
+            return next(int(line.split()[1]) for line in f if
+                        line.startswith('rchar'))
+    except (OSError, StopIteration):
+        return None
+
+
+def measure(storage, cache_dir):
+    """Load twice in this process. Return seconds and bytes for each."""
+    engine_mod = import_path('latex_engine',
+                             os.path.join(here, os.pardir, 'latex_engine.py'))
+    results = []
+    for _ in range(2):
+        before, started = rchar(), time.perf_counter()
+        engine = engine_mod.Engine(engine_mod.Headless({1: PREAMBLE}))
+        engine.load({'deoplete#sources#latex#storage': storage,
+                     'deoplete#sources#latex#cache_dir': cache_dir,
+                     'deoplete#sources#latex#index_worker': 0,
+                     'deoplete#sources#latex#prewarm_history': 0,
+                     'deoplete#sources#latex#usage_ranking': 0})
+        engine.set_packages(1)
+        elapsed = time.perf_counter() - started
+        after = rchar()
+        nbytes = (after - before if before is not None else 0) + getattr(
+            engine._packages, 'bytes_read', 0)
+        results.append((elapsed, nbytes))
+        engine.close()
+    return results
+
+
+def main(runs):
+    compact_json = import_path('compact_json',
+                               os.path.join(here, 'compact_json.py'))
+    with open(os.path.join(here, 'latest.json')) as f:
+        data = json.load(f)
+    print('%-6s %9s %10s %9s %10s %9s' % ('', 'file', 'cold ms', 'bytes',
+                                           'warm ms', 'bytes'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, storage in (('json', 'json'), ('zlib', 'pack'),
+                               ('lzma', 'pack')):
+            cache_dir = os.path.join(tmp, label)
+            os.makedirs(cache_dir)
+            fpath = os.path.join(here, 'latest.json')
+            if storage == 'pack':
+                fpath = os.path.join(cache_dir, 'latest.pack')
+                compact_json.pack(data, fpath, label)
+            cold, warm = [], []
+            for _ in range(runs):
+                out = subprocess.check_output(
+                    [sys.executable, __file__, '--one', storage, cache_dir])
+                one, two = json.loads(out.decode())
+                cold.append(one)
+                warm.append(two)
+            # Medians.
+            cold_s, cold_b = sorted(cold)[runs // 2]
+            warm_s, warm_b = sorted(warm)[runs // 2]
+            print('%-6s %9d %10.1f %9s %10.1f %9s' % (
+                label, os.path.getsize(fpath), cold_s * 1000, cold_b,
+                warm_s * 1000, warm_b))
+
+
+if __name__ == "__main__":
+
+    if sys.argv[1:2] == ['--one']:
+        print(json.dumps(measure(*sys.argv[2:4])))
+    else:
+        main(int(sys.argv[1]) if sys.argv[1:] else 5)
@@ -1,13 +1,98 @@
 #!/bin/python3
-"""Export compacted json file. ``sort_keys=True`` is hard coded."""
+"""Export compacted json file. ``sort_keys=True`` is hard coded.
+
+Given a third argument, "zlib" or "lzma", export a compressed pack instead,
+for the source's ``pack`` storage. Packages are compressed separately, so
+only those in use are ever decompressed. Command and environment ``sig``
+and ``info`` strings are moved to an uncompressed string table, which the
+source maps into memory, and replaced by ``{"@str": [offset, length]}``.
+Multi-part ``info`` is joined by newlines first. The layout is a line
+naming the format and method, a line of json mapping each package to the
+offset and length of its data, counted from the end of that line, plus its
+``info``, and locating the table, then the data and the table::
+
+    DLPK2 zlib
+    {"packages":{"amsmath":[0,1234,"..."],...},"strings":[56789,1011]}
+    <compressed json of each package, back to back><utf-8 strings>
+
+The source imports ``pack`` directly when the pack is missing or older than
+``latest.json``.
+"""
 
 import json
+import lzma
+import os
 import sys
+import tempfile
+import zlib
+
+MAGIC = 'DLPK2'
+METHODS = {'zlib': (lambda b: zlib.compress(b, 9), zlib.decompress),
+           'lzma': (lzma.compress, lzma.decompress)}
+
+
+def pack(data, fpath, method='zlib'):
+    """Write ``data``, shaped like ``latest.json``, to a new pack at
+    ``fpath``. It's assembled beside ``fpath``, in a temp file of its own
+    in case other editors are at it, too, and moved into place.
+    """
+    compress = METHODS[method][0]
+    index, blobs, offset = {}, [], 0
+    strings, table = {}, bytearray()
+
+    def ref(text):
+        if not isinstance(text, str):
+            text = '\n'.join(text)
+        if text not in strings:
+            encoded = text.encode()
+            strings[text] = {'@str': [len(table), len(encoded)]}
+            table.extend(encoded)
+        return strings[text]
+
+    for pname, pdata in sorted(data.items()):
+        pdata = dict(pdata)
+        for catname in ('commands', 'environments'):
+            if not pdata.get(catname):
+                continue
+            pdata[catname] = cat = dict(pdata[catname])
+            for entname, entdata in cat.items():
+                entdata = cat[entname] = dict(entdata)
+                if entdata.get('info'):
+                    entdata['info'] = ref(entdata['info'])
+                sig = entdata.get('sig')
+                if isinstance(sig, str) and sig:
+                    entdata['sig'] = ref(sig)
+                elif sig:
+                    entdata['sig'] = [ref(s) if s else s for s in sig]
+        blob = compress(json.dumps(pdata, separators=(',', ':'),
+                                   sort_keys=True).encode())
+        index[pname] = [offset, len(blob), pdata.get('info')]
+        blobs.append(blob)
+        offset += len(blob)
+    with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(fpath)),
+            prefix=os.path.basename(fpath) + '.', suffix='.tmp',
+            delete=False) as f:
+        try:
+            f.write(('%s %s\n' % (MAGIC, method)).encode())
+            f.write(json.dumps(dict(packages=index,
+                                    strings=[offset, len(table)]),
+                               separators=(',', ':'),
+                               sort_keys=True).encode() + b'\n')
+            for blob in blobs:
+                f.write(blob)
+            f.write(table)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, fpath)
 
-from common.fpaths import is_path
 
 if __name__ == "__main__":
 
+    from common.fpaths import is_path
+
     if is_path(sys.argv[2]):
         print('File "%s", exists, clobbering...' % sys.argv[2],
               file=sys.stderr)
@@ -16,5 +101,8 @@ if __name__ == "__main__":
         with open(sys.argv[1]) as f:
             data = json.load(f)
 
-    with open(sys.argv[2], 'w') as g:
-        json.dump(data, g, separators=(',', ':'), sort_keys=True)
+    if sys.argv[3:]:
+        pack(data, sys.argv[2], sys.argv[3])
+    else:
+        with open(sys.argv[2], 'w') as g:
+            json.dump(data, g, separators=(',', ':'), sort_keys=True)
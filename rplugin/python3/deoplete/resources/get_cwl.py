@@ -13,9 +13,6 @@ import os
 import re
 from collections import abc
 
-from common.fpaths import check_commit, save_backup
-from common.types import enlist
-
 # Prefer file i/o occur in local module's dir...
 CWD = os.curdir if __name__ == "__main__" else os.path.dirname(__loader__.path)
 SRCFILE = 'data/texstudio/completion'
@@ -39,22 +36,30 @@ def get_packages(cwl_dir):
         cwl_fpath = os.path.join(cwl_dir, cwl_fname)
         if not cwl_fname.endswith('.cwl') or not os.path.isfile(cwl_fpath):
             continue
-        pkgname = cwl_fname.partition('.')[0]
-        with open(cwl_fpath, 'r', encoding='UTF-8', errors='replace') as f:
-            # Get rid of comments and newline endings
-            lines = [l.strip() for l in f.readlines() if l.strip()]
-            # rename mislabeled/hybrid class-packages:
-            if any(l.startswith('# mode') and
-                   ('class' in l or '.cls' in l) for l in lines):
-                pkgname = ('class-' + pkgname if not
-                           pkgname.startswith('class-') else pkgname)
-            packages[pkgname] = {}
-            packages[pkgname].update(lines=lines)
-            packages[pkgname].update(environments={})
-            packages[pkgname].update(commands={})
-            packages[pkgname].update(options={})
+        pkgname, pkgdata = read_cwl(cwl_fpath)
+        packages[pkgname] = pkgdata
     return packages
 
+def read_cwl(cwl_fpath):
+    """Return ``(pkgname, data)`` for a single cwl file. Also used at
+    runtime for user-supplied files, so no pipeline imports here.
+    """
+    pkgname = os.path.basename(cwl_fpath).partition('.')[0]
+    with open(cwl_fpath, 'r', encoding='UTF-8', errors='replace') as f:
+        # Get rid of comments and newline endings
+        lines = [l.strip() for l in f.readlines() if l.strip()]
+    # rename mislabeled/hybrid class-packages:
+    if any(l.startswith('# mode') and
+           ('class' in l or '.cls' in l) for l in lines):
+        pkgname = ('class-' + pkgname if not
+                   pkgname.startswith('class-') else pkgname)
+    data = {}
+    data.update(lines=lines)
+    data.update(environments={})
+    data.update(commands={})
+    data.update(options={})
+    return pkgname, data
+
 def get_balanced(delims='(){}[]<>'):
     # From <http://stackoverflow.com/a/6753172/4932879>
     iparens = iter(delims)
@@ -302,6 +307,38 @@ def fill_packages(inpack):
                 data.update(environments=None)
     return packages
 
+def finalize_entry(package, category, entry):
+    """Rename and relocate harvested items to match the layout of
+    ``latest.json``. Shared by ``meld_mj_refman`` and the runtime loader.
+    """
+    #
+    # XXX - Skipping ``name`` and ``type`` keys for now...
+    #
+    # Add missing boilerplate struct items to item.
+    # Add symbol to 'commands'.
+    if category == 'commands':
+        entry.setdefault('symbol', None)
+        # These contain deprecated but used commands.
+        if package in ('latex-209', 'latex-l2tabu'):
+            entry.update(symbol='(obsolete)')
+    sig = entry.pop('signature')
+    # Rename ``signature`` to ``sig``.
+    entry.update(sig=sig)
+    # # Rename ``signature`` to ``info``.
+    # entry.update(info=sig)
+    #
+    # Add mode item.
+    entry.setdefault('mode', [])
+    # Add meta, populate with extra stuff.
+    meta = entry.setdefault('meta', {})
+    for m_key in ('classifiers', 'env_aliases',
+                  'environments', 'options'):
+        if m_key in entry:
+            m_item = entry.pop(m_key)
+            if m_item is not None:
+                meta.update({m_key: m_item})
+    return entry
+
 def get_tests(echo=None):
     r"""
     {} == 'm'           # math
@@ -378,8 +415,8 @@ def apply_classifiers(indict, classifier):
                 existing = indict.setdefault('environments', [m])
                 if existing != [m]:
                     # Never runs as of initial commit.
-                    indict.update(environments=enlist(existing, m,
-                                                      ret_type=list))
+                    indict.update(environments=sorted(set(existing) |
+                                                      {m}))
             if r and m not in mode and m in keys._fields[:2]:
                 mode.append(m)
         mode.sort()
@@ -407,10 +444,15 @@ def inspect_classifiers(packages, test, full=False):
                                 view if full is True else len(view)))
     return outlist
 
-check_commit(os.path.dirname(SRCFILE), PINNED_REV, hg=True, bail=True)
-packages = fill_packages(get_packages(os.path.join(CWD, SRCFILE)))
+def load_pinned():
+    """Parse the pinned TeXstudio checkout. Pipeline entry point."""
+    from common.fpaths import check_commit
+    check_commit(os.path.dirname(SRCFILE), PINNED_REV, hg=True, bail=True)
+    return fill_packages(get_packages(os.path.join(CWD, SRCFILE)))
 
 if __name__ == "__main__":
+    from common.fpaths import save_backup
+    packages = load_pinned()
     save_backup(CWD, OUTFILE)
     with open(os.path.join(CWD, OUTFILE), 'w') as f:
         json.dump(packages, f, indent=2, sort_keys=True)
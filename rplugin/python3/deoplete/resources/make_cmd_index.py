@@ -0,0 +1,49 @@
+#!/bin/python3
+"""Export a compact reverse index of commands to the packages providing
+them, for suggesting commands from packages not yet loaded. Each entry
+looks like ``"\\SI": [2, "siunitx"]``, where the leading int holds mode
+bits: 1 for math, 2 for text.
+
+Base (``latex-*``), ``misc-*`` and class packages are left out, as are
+commands the base defs already provide.
+"""
+
+import json
+import sys
+
+MODE_BITS = {'math': 1, 'text': 2}
+
+
+def make_index(packages):
+    base = set()
+    for pname, pdata in packages.items():
+        if pname.startswith('latex'):
+            base |= (pdata.get('commands') or {}).keys()
+    index = {}
+    for pname, pdata in sorted(packages.items()):
+        if pname.startswith(('latex', 'misc', 'class')):
+            continue
+        for cmd, cdata in (pdata.get('commands') or {}).items():
+            if cmd in base:
+                continue
+            entry = index.setdefault(cmd, [0])
+            for mode in cdata.get('mode') or ():
+                entry[0] |= MODE_BITS.get(mode, 0)
+            entry.append(pname)
+    return index
+
+
+if __name__ == "__main__":
+
+    from common.fpaths import is_path
+
+    if is_path(sys.argv[2]):
+        print('File "%s", exists, clobbering...' % sys.argv[2],
+              file=sys.stderr)
+
+    if is_path(sys.argv[1]):
+        with open(sys.argv[1]) as f:
+            data = json.load(f)
+
+    with open(sys.argv[2], 'w') as g:
+        json.dump(make_index(data), g, separators=(',', ':'), sort_keys=True)
@@ -0,0 +1,110 @@
+#!/bin/python3
+"""Export ``latest.json`` as an sqlite3 database, for the source's optional
+``sqlite`` storage. Packages, commands, environments and package options
+get a table each, indexed by name. ``docs`` is a full-text index over the
+``info`` strings of commands and environments.
+
+Entries are stored whole as json text in ``data``, with the columns the
+source queries pulled out alongside. The source imports ``build`` directly
+when the database is missing or older than ``latest.json``.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+
+SCHEMA = """
+CREATE TABLE packages (name TEXT PRIMARY KEY, info TEXT, includes TEXT);
+CREATE TABLE commands (package TEXT, name TEXT, symbol TEXT, info TEXT,
+                       data TEXT);
+CREATE TABLE environments (package TEXT, name TEXT, info TEXT, data TEXT);
+CREATE TABLE options (package TEXT, command TEXT, name TEXT, data TEXT);
+CREATE INDEX commands_package ON commands (package);
+CREATE INDEX commands_name ON commands (name);
+CREATE INDEX environments_package ON environments (package);
+CREATE INDEX environments_name ON environments (name);
+CREATE INDEX options_package ON options (package);
+"""
+
+
+def dumps(value):
+    return None if value is None else json.dumps(value,
+                                                 separators=(',', ':'))
+
+
+def info_str(info):
+    return info if isinstance(info, (str, type(None))) else '\n'.join(info)
+
+
+def build(data, fpath):
+    """Write ``data``, shaped like ``latest.json``, to a new database at
+    ``fpath``. It's assembled beside ``fpath``, in a temp file of its own
+    in case other editors are at it, too, and moved into place.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fpath)),
+                               prefix=os.path.basename(fpath) + '.',
+                               suffix='.tmp')
+    os.close(fd)
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.executescript(SCHEMA)
+        try:
+            conn.execute('CREATE VIRTUAL TABLE docs USING fts5('
+                         'category UNINDEXED, package UNINDEXED, '
+                         'name UNINDEXED, info)')
+        except sqlite3.OperationalError:
+            conn.execute('CREATE VIRTUAL TABLE docs USING fts4('
+                         'category, package, name, info, '
+                         'notindexed=category, notindexed=package, '
+                         'notindexed=name)')
+        for pname, pdata in sorted(data.items()):
+            conn.execute('INSERT INTO packages VALUES (?, ?, ?)',
+                         (pname, info_str(pdata.get('info')),
+                          dumps(pdata.get('includes'))))
+            conn.executemany(
+                'INSERT INTO commands VALUES (?, ?, ?, ?, ?)',
+                ((pname, cmd, cdata.get('symbol'), info_str(cdata.get('info')),
+                  dumps(cdata)) for cmd, cdata in
+                 sorted((pdata.get('commands') or {}).items())))
+            conn.executemany(
+                'INSERT INTO environments VALUES (?, ?, ?, ?)',
+                ((pname, env, info_str(edata.get('info')), dumps(edata)) for
+                 env, edata in sorted((pdata.get('environments') or
+                                       {}).items())))
+            for catname, cats in (('commands', pdata.get('commands')),
+                                  ('environments', pdata.get('environments'))):
+                conn.executemany(
+                    'INSERT INTO docs VALUES (?, ?, ?, ?)',
+                    ((catname, pname, entname, info_str(entdata['info'])) for
+                     entname, entdata in sorted((cats or {}).items()) if
+                     entdata.get('info')))
+            for optcmd, opts in sorted((pdata.get('options') or {}).items()):
+                # Either a list of names or ``{name: {field: [...]}}``.
+                conn.executemany(
+                    'INSERT INTO options VALUES (?, ?, ?, ?)',
+                    ((pname, optcmd, opt, json.dumps(opts[opt]) if
+                      isinstance(opts, dict) else None) for opt in opts))
+        conn.commit()
+        conn.close()
+        os.replace(tmp, fpath)
+    except BaseException:
+        conn.close()
+        os.remove(tmp)
+        raise
+
+
+if __name__ == "__main__":
+
+    from common.fpaths import is_path
+
+    if is_path(sys.argv[2]):
+        print('File "%s", exists, clobbering...' % sys.argv[2],
+              file=sys.stderr)
+
+    if is_path(sys.argv[1]):
+        with open(sys.argv[1]) as f:
+            data = json.load(f)
+
+    build(data, sys.argv[2])
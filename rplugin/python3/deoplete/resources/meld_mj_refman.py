@@ -19,7 +19,7 @@ import json
 
 from get_refman import outdict as RF
 from get_unimath import outdict as UD
-from get_cwl import packages as CP
+from get_cwl import finalize_entry, load_pinned
 
 from common.fpaths import is_path, save_backup
 from common.types import enlist, is_seq
@@ -30,6 +30,8 @@ MJ_SRCFILE = 'lists/update_mathjax.json'
 OUTFILES = ('lists/union_mj_refman.json', 'lists/union_cwl.json')
 MANIDIR = 'data/manifests'
 
+CP = load_pinned()
+
 
 def get_manifest(name):
     # XXX - Missing as of initial commit: amscls, babel, graphics, latexbug
@@ -91,32 +93,7 @@ def packs_by_cat():
                             continue
                         curpacks = pcat.setdefault(item, set())
                         curpacks.add(package)
-                        #
-                        # XXX - Skipping ``name`` and ``type`` keys for now...
-                        #
-                        # Add missing boilerplate struct items to item.
-                        # Add symbol to 'commands'.
-                        if category == 'commands':
-                            catvals[item].setdefault('symbol', None)
-                            # These contain deprecated but used commands.
-                            if package in ('latex-209', 'latex-l2tabu'):
-                                catvals[item].update(symbol='(obsolete)')
-                        sig = catvals[item].pop('signature')
-                        # Rename ``signature`` to ``sig``.
-                        catvals[item].update(sig=sig)
-                        # # Rename ``signature`` to ``info``.
-                        # catvals[item].update(info=sig)
-                        #
-                        # Add mode item.
-                        catvals[item].setdefault('mode', [])
-                        # Add meta, populate with extra stuff.
-                        meta = catvals[item].setdefault('meta', {})
-                        for m_key in ('classifiers', 'env_aliases',
-                                      'environments', 'options'):
-                            if m_key in catvals[item]:
-                                m_item = catvals[item].pop(m_key)
-                                if m_item is not None:
-                                    meta.update({m_key: m_item})
+                        finalize_entry(package, category, catvals[item])
     #
     def lookup_packs(category, member):
         for cat, pcat in zip(('commands', 'environments', 'options'),